@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Compare the old per-ID generator lookup with the single-pass index, against a set and SeenTickets
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import script
+
+TOTAL = int(os.getenv("BENCH_TOTAL", "5000"))
+NEW = int(os.getenv("BENCH_NEW", "1000"))
+
+tickets = [{"id": i, "name": f"Ticket {i}"} for i in range(1, TOTAL + 1)]
+previous_str = set(str(i) for i in range(1, TOTAL - NEW + 1))
+previous_int = set(range(1, TOTAL - NEW + 1))
+previous_seen = script.SeenTickets()
+for ticket_id in range(1, TOTAL - NEW + 1):
+    previous_seen.add(ticket_id)
+
+def old_diff():
+    current = set(str(ticket['id']) for ticket in tickets if 'id' in ticket)
+    found = []
+    for ticket_id in current - previous_str:
+        found.append(next((t for t in tickets if str(t.get('id')) == ticket_id), None))
+    return found
+
+def new_diff():
+    return script.diff_new_tickets(tickets, previous_int)[1]
+
+def seen_diff():
+    return script.diff_new_tickets(tickets, previous_seen)[1]
+
+if __name__ == "__main__":
+    assert len(old_diff()) == len(new_diff()) == len(seen_diff()) == NEW
+    runs = (("generator lookup", old_diff, 1), ("indexed diff", new_diff, 20), ("seen tracker", seen_diff, 20))
+    for name, func, number in runs:
+        best = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print(f"{name:>16}: {best * 1000:9.3f} ms for {NEW} new of {TOTAL} tickets")
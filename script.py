@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 import os
+import base64
 import time
-import requests
 import asyncio
 import logging
 import aiohttp
+from aiohttp import web
 import signal
+import sqlite3
+import array
+import bisect
+import itertools
+import json
+import random
+import hmac
+import hashlib
+import html
+import re
+import datetime
+import contextvars
+import collections
+import multiprocessing
 import sys
 
 # Configuration from environment variables GLPI
@@ -18,167 +33,2121 @@ MATRIX_HOMESERVER = os.getenv("MATRIX_HOMESERVER")
 MATRIX_TOKEN = os.getenv("MATRIX_TOKEN")
 ROOM_ID = os.getenv("ROOM_ID")
 MESSAGE = os.getenv("MESSAGE")
+# Polling
+# "list" reads the first page of GET /Ticket, "paged" follows Content-Range through every page,
+# "search" only asks search/Ticket for IDs above the last one seen, "newest" reads a small
+# newest-first window of GET /Ticket and only widens it while every row in it is new, "changes"
+# asks search/Ticket for tickets created or modified since the last change read
+GLPI_FETCH_MODE = os.getenv("GLPI_FETCH_MODE", "list")
+GLPI_SEARCH_RANGE = int(os.getenv("GLPI_SEARCH_RANGE", "200"))
+GLPI_WINDOW_SIZE = int(os.getenv("GLPI_WINDOW_SIZE", "20"))
+GLPI_WINDOW_MAX = int(os.getenv("GLPI_WINDOW_MAX", "1000"))
+# "changes" mode: seconds of the change feed read again on each poll for late commits
+GLPI_CHANGE_OVERLAP = int(os.getenv("GLPI_CHANGE_OVERLAP", "60"))
+# Poll interval bounds in seconds, tickets expected per poll when adapting to the arrival rate,
+# random jitter as a fraction of the interval, and optional windows overriding the bounds, e.g.
+# "mon-fri 08:00-18:00 10-30; * 20:00-07:00 300-900"
+POLL_INTERVAL_MIN = float(os.getenv("POLL_INTERVAL_MIN", "15"))
+POLL_INTERVAL_MAX = float(os.getenv("POLL_INTERVAL_MAX", "60"))
+POLL_TARGET_TICKETS = float(os.getenv("POLL_TARGET_TICKETS", "1"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
+POLL_WINDOWS = os.getenv("POLL_WINDOWS", "")
+# Webhook receiver for GLPI 10+ ticket events, off unless WEBHOOK_PORT is set. Polling then
+# only runs every WEBHOOK_POLL_INTERVAL seconds to catch anything a webhook missed
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "0"))
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/glpi/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_SKEW = int(os.getenv("WEBHOOK_MAX_SKEW", "300"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "900"))
+# Announce status, assignee and priority changes of known tickets, with this message prefix
+TRACK_CHANGES = os.getenv("TRACK_CHANGES", "false").lower() == "true"
+UPDATE_MESSAGE = os.getenv("UPDATE_MESSAGE", "✏️ Ticket updated:")
+# Ticket sub-items to announce, among ITILFollowup, TicketTask and ITILSolution (comma separated)
+SUBITEM_TYPES = os.getenv("SUBITEM_TYPES", "")
+# Number of IDs below the highest one seen that are still tracked individually for late arrivals
+SEEN_WINDOW = int(os.getenv("SEEN_WINDOW", "65536"))
+# SQLite file keeping the seen tickets across restarts, empty to disable
+STATE_FILE = os.getenv("STATE_FILE", "glpi-matrix-notifier.db")
+GLPI_PAGE_SIZE = int(os.getenv("GLPI_PAGE_SIZE", "50"))
+GLPI_PAGE_CONCURRENCY = int(os.getenv("GLPI_PAGE_CONCURRENCY", "4"))
+# Matrix pacing: messages per second and burst allowed before pacing starts, per homeserver
+MATRIX_RATE = float(os.getenv("MATRIX_RATE", "0.2"))
+MATRIX_BURST = int(os.getenv("MATRIX_BURST", "10"))
+MATRIX_MAX_RETRIES = int(os.getenv("MATRIX_MAX_RETRIES", "10"))
+# Matrix delivery: rooms sent to at the same time, and whether messages keep their order within a room
+MATRIX_SEND_CONCURRENCY = int(os.getenv("MATRIX_SEND_CONCURRENCY", "4"))
+MATRIX_ROOM_ORDERING = os.getenv("MATRIX_ROOM_ORDERING", "true").lower() != "false"
+# Queue between the GLPI poller and the Matrix sender, and what to do when it is full:
+# "block" the poller, "drop_oldest" notification, or collapse the queue into a "digest"
+MATRIX_QUEUE_SIZE = int(os.getenv("MATRIX_QUEUE_SIZE", "1000"))
+MATRIX_QUEUE_POLICY = os.getenv("MATRIX_QUEUE_POLICY", "block")
+MATRIX_DRAIN_TIMEOUT = int(os.getenv("MATRIX_DRAIN_TIMEOUT", "30"))
+# Append-only journal of notifications not yet delivered, replayed at startup (empty to disable)
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "glpi-matrix-notifier.journal")
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "1000"))
+# Burst coalescing: wait this many seconds for a burst to pile up, then send rooms with at least
+# DIGEST_THRESHOLD notifications as one digest listing at most DIGEST_MAX_LINES of them (0 disables)
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "1"))
+DIGEST_THRESHOLD = int(os.getenv("DIGEST_THRESHOLD", "10"))
+DIGEST_MAX_LINES = int(os.getenv("DIGEST_MAX_LINES", "50"))
+# Circuit breakers: consecutive failures before an upstream is considered down, and the bounds
+# of the jittered exponential backoff used between retries
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", "5"))
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", "300"))
+# HTTP connection pools, one long-lived session per upstream
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "90"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_TIMEOUTS = {"glpi": 20, "matrix": 10}
+# GLPI session: re-login before the token reaches this age, ping it when polling has been idle this long
+GLPI_SESSION_REFRESH = int(os.getenv("GLPI_SESSION_REFRESH", "1200"))
+GLPI_KEEPALIVE_INTERVAL = int(os.getenv("GLPI_KEEPALIVE_INTERVAL", "300"))
+
+# GLPI search option IDs for the Ticket columns we read back
+GLPI_TICKET_SEARCH_FIELDS = {
+    "1": "name",
+    "2": "id",
+    "15": "date_creation",
+    "19": "date_mod",
+    # Read back for room routing. Search results carry display names for entities and categories
+    "80": "entity",
+    "7": "category",
+    "3": "priority",
+    "14": "type",
+    "71": "requester_group",
+    # Read back for change tracking
+    "12": "status",
+    "5": "assignee",
+}
+
+# Tickets looked up per search/Ticket request when naming the tickets of new sub-items
+GLPI_ID_BATCH = 50
+
+# Message prefix and column holding the ticket ID of each announced sub-item type
+SUBITEM_MESSAGES = {
+    "ITILFollowup": "💬 New follow-up on",
+    "TicketTask": "📋 New task on",
+    "ITILSolution": "✅ Solution proposed for",
+}
+SUBITEM_TICKET_KEYS = {"ITILFollowup": "items_id", "TicketTask": "tickets_id", "ITILSolution": "items_id"}
+SUBITEM_EXCERPT_LENGTH = 200
+
+GLPI_TICKET_STATUSES = {1: "New", 2: "Assigned", 3: "Planned", 4: "Pending", 5: "Solved", 6: "Closed"}
+
+# JSON routing table sending tickets to rooms by entity, category, priority, type or requester group.
+# Tickets no route matches go to ROOM_ID
+ROUTES_FILE = os.getenv("ROUTES_FILE")
+
+# Multi-tenant mode: JSON file listing the GLPI instances and rooms to monitor from this process
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+REQUIRED_SETTINGS = [
+    "GLPI_API_URL", "GLPI_USERNAME", "GLPI_PASSWORD", "GLPI_APP_TOKEN",
+    "MATRIX_HOMESERVER", "MATRIX_TOKEN", "ROOM_ID", "MESSAGE"
+]
+# Worker processes sharing the tenants of TENANTS_FILE (1 runs everything in this process),
+# and seconds between the statistics each worker reports to the supervisor
+WORKERS = int(os.getenv("WORKERS", "1"))
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", "60"))
+# Settings a tenant can override, anything it leaves out falls back to the environment
+TENANT_SETTINGS = REQUIRED_SETTINGS + [
+    "GLPI_FETCH_MODE", "WEBHOOK_PORT", "WEBHOOK_SECRET", "WEBHOOK_PATH", "ROUTES_FILE",
+    "TRACK_CHANGES", "UPDATE_MESSAGE", "SUBITEM_TYPES"
+]
+
+# Parse a tenant setting like the environment variable it overrides, going by the type of its default
+def _parse_setting(value, default):
+    if isinstance(default, bool):
+        return value if isinstance(value, bool) else str(value).lower() == "true"
+    if isinstance(default, (int, float)) and value is not None:
+        return type(default)(value)
+    return value
+
+# One monitored GLPI instance. Settings are read as attributes named like the environment variables
+class Tenant:
+    def __init__(self, name=None, settings=None):
+        self.name = name
+        self.settings = {
+            key: _parse_setting(value, globals()[key]) if key in TENANT_SETTINGS else value
+            for key, value in (settings or {}).items()
+        }
+
+    def __getattr__(self, key):
+        if key in TENANT_SETTINGS:
+            return self.settings.get(key, globals()[key])
+        raise AttributeError(key)
+
+    @property
+    def state_key(self):
+        return "tickets" if self.name is None else f"tickets:{self.name}"
+
+    @property
+    def journal_path(self):
+        if not JOURNAL_FILE or self.name is None:
+            return JOURNAL_FILE
+        return f"{JOURNAL_FILE}.{self.name}"
+
+DEFAULT_TENANT = Tenant()
+_current_tenant = contextvars.ContextVar("tenant", default=DEFAULT_TENANT)
+
+def current_tenant():
+    return _current_tenant.get()
+
+# Read {"tenants": [{"name": "acme", "GLPI_API_URL": "...", "ROOM_ID": "...", ...}, ...]}
+def load_tenants(path):
+    with open(path, encoding="utf-8") as tenants_file:
+        data = json.load(tenants_file)
+    entries = data.get("tenants", []) if isinstance(data, dict) else data
+    tenants = []
+    for entry in entries:
+        settings = dict(entry)
+        name = str(settings.pop("name"))
+        tenants.append(Tenant(name, settings))
+    return tenants
+
+# Counters reported by workers to the supervisor
+stats = collections.Counter()
+
+class TenantLogFilter(logging.Filter):
+    def filter(self, record):
+        name = current_tenant().name
+        record.tenant = f"[{name}] " if name else ""
+        return True
 
 # Logging configuration
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(tenant)s%(message)s')
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TenantLogFilter())
 logger = logging.getLogger(__name__)
 
 def check_env():
-    missing = []
-    for var in [
-        "GLPI_API_URL", "GLPI_USERNAME", "GLPI_PASSWORD", "GLPI_APP_TOKEN",
-        "MATRIX_HOMESERVER", "MATRIX_TOKEN", "ROOM_ID", "MESSAGE"
-    ]:
-        if not os.getenv(var):
-            missing.append(var)
-    if missing:
-        logger.error(f"Missing environment variables: {', '.join(missing)}")
+    if TENANTS_FILE:
+        try:
+            tenants = load_tenants(TENANTS_FILE)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Cannot read tenants from {TENANTS_FILE}: {e}")
+            sys.exit(1)
+    else:
+        tenants = [DEFAULT_TENANT]
+    failed = False
+    try:
+        parse_poll_windows(POLL_WINDOWS)
+    except ValueError as e:
+        logger.error(f"Invalid POLL_WINDOWS {POLL_WINDOWS!r}: {e}")
+        failed = True
+    webhook_ports = {}
+    for tenant in tenants:
+        missing = [var for var in REQUIRED_SETTINGS if not getattr(tenant, var)]
+        where = f" for tenant {tenant.name}" if tenant.name else ""
+        if tenant.WEBHOOK_PORT and tenant.WEBHOOK_SECRET:
+            if tenant.WEBHOOK_PORT in webhook_ports:
+                logger.error(
+                    f"WEBHOOK_PORT {tenant.WEBHOOK_PORT}{where} is already used by tenant "
+                    f"{webhook_ports[tenant.WEBHOOK_PORT]}"
+                )
+                failed = True
+            webhook_ports[tenant.WEBHOOK_PORT] = tenant.name
+        if missing:
+            logger.error(f"Missing environment variables{where}: {', '.join(missing)}")
+            failed = True
+        unknown = set(filter(None, (name.strip() for name in tenant.SUBITEM_TYPES.split(","))))
+        unknown -= set(SUBITEM_MESSAGES)
+        if unknown:
+            logger.error(f"Unknown SUBITEM_TYPES{where}: {', '.join(sorted(unknown))}")
+            failed = True
+        if tenant.ROUTES_FILE:
+            try:
+                load_routing_table(tenant.ROUTES_FILE)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Cannot read routes{where} from {tenant.ROUTES_FILE}: {e}")
+                failed = True
+    if failed:
         sys.exit(1)
 
+_http_sessions = {}
+
+# Return the shared aiohttp session for an upstream ("glpi" or "matrix"), creating it on first use
+def get_http_session(name):
+    session = _http_sessions.get(name)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            # Tenants share these sessions, GLPI session cookies must not leak between them
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUTS[name]),
+        )
+        _http_sessions[name] = session
+    return session
+
+async def close_http_sessions():
+    while _http_sessions:
+        _, session = _http_sessions.popitem()
+        await session.close()
+
+# Track the health of one upstream. After BREAKER_THRESHOLD consecutive failures the circuit opens
+# and calls are refused until the backoff expires; then a single probe is let through (half-open)
+# and closes the circuit again if it succeeds
+class CircuitBreaker:
+    def __init__(self, name, threshold=None, base_delay=None, max_delay=None):
+        self.name = name
+        self.threshold = BREAKER_THRESHOLD if threshold is None else threshold
+        self.base_delay = BACKOFF_BASE if base_delay is None else base_delay
+        self.max_delay = BACKOFF_MAX if max_delay is None else max_delay
+        self.state = "closed"
+        self.failures = 0
+        self.opened_until = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() < self.opened_until:
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def backoff(self):
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, self.failures - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    # Seconds to wait before trying the upstream again
+    def retry_delay(self):
+        if self.state == "open":
+            return max(0.0, self.opened_until - time.monotonic())
+        return self.backoff()
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"{self.name} is reachable again, closing circuit")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            delay = self.backoff()
+            if self.state != "open":
+                logger.warning(f"{self.name} failed {self.failures} times, pausing calls for {delay:.0f}s")
+            self.state = "open"
+            self.opened_until = time.monotonic() + delay
+
+_circuit_breakers = {}
+
+def get_circuit_breaker(name):
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        breaker = CircuitBreaker(name)
+        _circuit_breakers[name] = breaker
+    return breaker
+
+# Breakers are per upstream URL, so tenants on the same GLPI or homeserver share one
+def glpi_breaker():
+    return get_circuit_breaker(f"GLPI {current_tenant().GLPI_API_URL}")
+
+def matrix_breaker():
+    return get_circuit_breaker(f"Matrix {current_tenant().MATRIX_HOMESERVER}")
+
+# Feed an HTTP status into the upstream's circuit breaker: 5xx counts as a failure, any other
+# answer (a 403 or 404 included) proves the upstream is reachable
+def record_upstream_status(breaker, status):
+    if status >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
 # Initialize a GLPI session and get the session token
-def init_glpi_session():
+async def init_glpi_session():
+    tenant = current_tenant()
     try:
+        credentials = base64.b64encode(f"{tenant.GLPI_USERNAME}:{tenant.GLPI_PASSWORD}".encode()).decode()
         headers = {
             "Content-Type": "application/json",
-            "App-Token": GLPI_APP_TOKEN
+            "App-Token": tenant.GLPI_APP_TOKEN,
+            "Authorization": f"Basic {credentials}"
         }
-        resp = requests.get(f"{GLPI_API_URL}/initSession", headers=headers, auth=(GLPI_USERNAME, GLPI_PASSWORD), timeout=10)
-        if resp.status_code == 200:
-            session_token = resp.json().get("session_token")
-            logger.info("GLPI session initialized successfully")
-            return session_token
-        else:
-            logger.error(f"Error initializing session: {resp.status_code}, {resp.text}")
-            return None
+        session = get_http_session("glpi")
+        async with session.get(f"{tenant.GLPI_API_URL}/initSession", headers=headers,
+                               timeout=aiohttp.ClientTimeout(total=10)) as response:
+            record_upstream_status(glpi_breaker(), response.status)
+            if response.status == 200:
+                data = await response.json()
+                session_token = data.get("session_token")
+                logger.info("GLPI session initialized successfully")
+                return session_token
+            else:
+                error_text = await response.text()
+                logger.error(f"Error initializing session: {response.status}, {error_text}")
+                return None
     except Exception as e:
         logger.error(f"Error initializing session: {e}")
+        glpi_breaker().record_failure()
         return None
 
 # Terminate a GLPI session
-def kill_glpi_session(session_token):
+async def kill_glpi_session(session_token):
+    tenant = current_tenant()
     try:
         headers = {
             "Session-Token": session_token,
             "Content-Type": "application/json",
-            "App-Token": GLPI_APP_TOKEN
+            "App-Token": tenant.GLPI_APP_TOKEN
         }
-        requests.get(f"{GLPI_API_URL}/killSession", headers=headers, timeout=5)
+        session = get_http_session("glpi")
+        async with session.get(f"{tenant.GLPI_API_URL}/killSession", headers=headers,
+                               timeout=aiohttp.ClientTimeout(total=5)):
+            pass
         logger.info("GLPI session terminated successfully")
     except Exception as e:
         logger.error(f"Error terminating session: {e}")
 
+# Keep a GLPI session token fresh: re-login before it ages out and ping it while polling is idle
+class GlpiSessionManager:
+    def __init__(self, refresh_after=None, keepalive_interval=None):
+        self.refresh_after = GLPI_SESSION_REFRESH if refresh_after is None else refresh_after
+        self.keepalive_interval = GLPI_KEEPALIVE_INTERVAL if keepalive_interval is None else keepalive_interval
+        self.token = None
+        self.issued_at = 0.0
+        self.last_used = 0.0
+        self._task = None
+        self._refreshing = None
+
+    async def get_token(self):
+        if self.token is None or time.monotonic() - self.issued_at >= self.refresh_after:
+            await self.refresh(self.token)
+        self.last_used = time.monotonic()
+        return self.token
+
+    # Re-login once for every concurrent caller. Passing the token that failed lets a caller
+    # pick up a token a sibling already renewed instead of starting another login
+    async def refresh(self, stale_token=None):
+        if stale_token is not None and self.token is not None and self.token != stale_token:
+            return self.token
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        return await asyncio.shield(self._refreshing)
+
+    # Open a new session first, then drop the old one, so callers never wait on a missing token
+    async def _refresh(self):
+        try:
+            new_token = await init_glpi_session()
+            if not new_token:
+                return None
+            old_token, self.token = self.token, new_token
+            self.issued_at = self.last_used = time.monotonic()
+            if old_token:
+                await kill_glpi_session(old_token)
+            return self.token
+        finally:
+            self._refreshing = None
+
+    async def keepalive(self):
+        tenant = current_tenant()
+        try:
+            headers = {
+                "Session-Token": self.token,
+                "Content-Type": "application/json",
+                "App-Token": tenant.GLPI_APP_TOKEN,
+            }
+            session = get_http_session("glpi")
+            async with session.get(f"{tenant.GLPI_API_URL}/getFullSession", headers=headers) as response:
+                if response.status == 401:
+                    logger.info("GLPI session expired while idle, re-initializing")
+                    await self.refresh(headers["Session-Token"])
+                elif response.status == 200:
+                    self.last_used = time.monotonic()
+                else:
+                    logger.warning(f"GLPI keep-alive failed: {response.status}")
+        except Exception as e:
+            logger.error(f"Error during GLPI keep-alive: {e}")
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            next_refresh = self.issued_at + self.refresh_after
+            next_keepalive = self.last_used + self.keepalive_interval
+            await asyncio.sleep(max(1.0, min(next_refresh, next_keepalive) - now))
+            now = time.monotonic()
+            if self.token is None or now - self.issued_at >= self.refresh_after:
+                breaker = glpi_breaker()
+                if not breaker.allow():
+                    await asyncio.sleep(breaker.retry_delay())
+                    continue
+                logger.info("Refreshing GLPI session before it expires")
+                if not await self.refresh():
+                    # The deadline stays in the past, wait for the backoff instead of retrying every second
+                    await asyncio.sleep(breaker.retry_delay())
+            elif now - self.last_used >= self.keepalive_interval:
+                await self.keepalive()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.token:
+            await kill_glpi_session(self.token)
+            self.token = None
+
 async def fetch_glpi_tickets(session_token):
+    tenant = current_tenant()
     try:
         headers = {
             "Session-Token": session_token,
             "Content-Type": "application/json",
-            "App-Token": GLPI_APP_TOKEN,
+            "App-Token": tenant.GLPI_APP_TOKEN,
         }
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=20)) as session:
-            async with session.get(f"{GLPI_API_URL}/Ticket", headers=headers) as response:
+        session = get_http_session("glpi")
+        async with session.get(f"{tenant.GLPI_API_URL}/Ticket", headers=headers) as response:
+            record_upstream_status(glpi_breaker(), response.status)
+            if response.status in (200, 206):
+                data = await response.json()
+                if isinstance(data, list):
+                    tickets = data
+                else:
+                    tickets = data.get("data", [])
+                logger.info(f"Retrieved {len(tickets)} tickets from GLPI")
+                return tickets
+            elif response.status == 401:  # Session expired/invalid
+                logger.warning("GLPI session expired, need to re-authenticate")
+                return None
+            else:
+                error_text = await response.text()
+                logger.error(
+                    f"Error fetching tickets: {response.status}, {error_text}"
+                )
+                return []
+    except Exception as e:
+        logger.error(f"Error fetching tickets: {e}")
+        glpi_breaker().record_failure()
+        return []
+
+# Parse a GLPI Content-Range header ("0-49/1234") into (start, end, total)
+def _parse_content_range(value):
+    if not value:
+        return None
+    try:
+        window, total = value.strip().split("/")
+        start, end = window.split("-")
+        return int(start), int(end), int(total)
+    except ValueError:
+        return None
+
+async def _fetch_glpi_ticket_page(session, headers, start, end):
+    tenant = current_tenant()
+    params = {"range": f"{start}-{end}"}
+    async with session.get(f"{tenant.GLPI_API_URL}/Ticket", headers=headers, params=params) as response:
+        record_upstream_status(glpi_breaker(), response.status)
+        if response.status in (200, 206):
+            data = await response.json()
+            tickets = data if isinstance(data, list) else data.get("data", [])
+            return response.status, tickets, _parse_content_range(response.headers.get("Content-Range"))
+        error_text = await response.text()
+        logger.error(f"Error fetching tickets {start}-{end}: {response.status}, {error_text}")
+        return response.status, None, None
+
+# Fetch every page of GET /Ticket, requesting the remaining ranges concurrently
+async def fetch_all_glpi_tickets(session_token):
+    tenant = current_tenant()
+    try:
+        headers = {
+            "Session-Token": session_token,
+            "Content-Type": "application/json",
+            "App-Token": tenant.GLPI_APP_TOKEN,
+        }
+        session = get_http_session("glpi")
+        status, tickets, content_range = await _fetch_glpi_ticket_page(session, headers, 0, GLPI_PAGE_SIZE - 1)
+        if status == 401:  # Session expired/invalid
+            logger.warning("GLPI session expired, need to re-authenticate")
+            return None
+        if tickets is None:
+            return []
+        if content_range:
+            total = content_range[2]
+            windows = [
+                (start, min(start + GLPI_PAGE_SIZE, total) - 1)
+                for start in range(GLPI_PAGE_SIZE, total, GLPI_PAGE_SIZE)
+            ]
+            semaphore = asyncio.Semaphore(GLPI_PAGE_CONCURRENCY)
+
+            async def fetch_window(start, end):
+                async with semaphore:
+                    return await _fetch_glpi_ticket_page(session, headers, start, end)
+
+            pages = await asyncio.gather(*(fetch_window(start, end) for start, end in windows))
+            for status, page, _ in pages:
+                if status == 401:
+                    logger.warning("GLPI session expired, need to re-authenticate")
+                    return None
+                if page is None:
+                    # A partial listing would make missing tickets look new on the next poll
+                    return []
+                tickets.extend(page)
+        logger.info(f"Retrieved {len(tickets)} tickets from GLPI")
+        return tickets
+    except Exception as e:
+        logger.error(f"Error fetching tickets: {e}")
+        glpi_breaker().record_failure()
+        return []
+
+# Fetch the newest rows of an itemtype (Ticket, ITILFollowup...) first, as a window of at most limit
+# rows. Returns (status, rows): rows is None unless GLPI answered with the listing, status is None
+# when the request itself failed
+async def _fetch_newest_glpi_page(session_token, itemtype, limit):
+    tenant = current_tenant()
+    try:
+        headers = {
+            "Session-Token": session_token,
+            "Content-Type": "application/json",
+            "App-Token": tenant.GLPI_APP_TOKEN,
+        }
+        params = {"sort": "id", "order": "DESC", "range": f"0-{limit - 1}"}
+        session = get_http_session("glpi")
+        async with session.get(f"{tenant.GLPI_API_URL}/{itemtype}", headers=headers, params=params) as response:
+            record_upstream_status(glpi_breaker(), response.status)
+            if response.status in (200, 206):
+                data = await response.json()
+                items = data if isinstance(data, list) else data.get("data", [])
+                for item in items:
+                    item["id"] = int(item["id"])
+                return response.status, items
+            elif response.status == 401:  # Session expired/invalid
+                logger.warning("GLPI session expired, need to re-authenticate")
+            else:
+                error_text = await response.text()
+                logger.error(
+                    f"Error fetching newest {itemtype}: {response.status}, {error_text}"
+                )
+            return response.status, None
+    except Exception as e:
+        logger.error(f"Error fetching newest {itemtype}: {e}")
+        glpi_breaker().record_failure()
+        return None, None
+
+async def fetch_newest_glpi_items(session_token, itemtype, limit):
+    status, items = await _fetch_newest_glpi_page(session_token, itemtype, limit)
+    if status == 401:
+        return None
+    return items if items is not None else []
+
+async def fetch_newest_glpi_tickets(session_token, limit):
+    return await fetch_newest_glpi_items(session_token, "Ticket", limit)
+
+# Return the unseen rows among the newest ones, doubling the window until it reaches a row already seen
+async def _fetch_new_window(fetch_newest, seen, description):
+    limit = GLPI_WINDOW_SIZE
+    while True:
+        rows = await fetch_newest(limit)
+        if rows is None:
+            return None
+        new_rows = [row for row in rows if row["id"] not in seen]
+        if len(new_rows) < limit or limit >= GLPI_WINDOW_MAX:
+            logger.info(f"Retrieved {len(new_rows)} new {description} from a window of {limit}")
+            new_rows.reverse()
+            return new_rows
+        limit = min(limit * 2, GLPI_WINDOW_MAX)
+
+async def fetch_new_glpi_tickets_window(session_token, seen):
+    return await _fetch_new_window(lambda limit: fetch_newest_glpi_tickets(session_token, limit), seen, "tickets")
+
+async def fetch_new_glpi_items_window(session_token, itemtype, seen):
+    return await _fetch_new_window(
+        lambda limit: fetch_newest_glpi_items(session_token, itemtype, limit), seen, itemtype
+    )
+
+def _normalize_search_row(row, fields=GLPI_TICKET_SEARCH_FIELDS):
+    item = {}
+    for field_id, key in fields.items():
+        if field_id in row:
+            item[key] = row[field_id]
+    if "id" in item:
+        item["id"] = int(item["id"])
+    return item
+
+# Run a search/<itemtype> query reading back `fields`, returns None when the session expired
+async def _search_glpi(session_token, itemtype, params, fields, description):
+    tenant = current_tenant()
+    try:
+        headers = {
+            "Session-Token": session_token,
+            "Content-Type": "application/json",
+            "App-Token": tenant.GLPI_APP_TOKEN,
+        }
+        params = dict(params)
+        for i, field_id in enumerate(fields):
+            params[f"forcedisplay[{i}]"] = field_id
+        session = get_http_session("glpi")
+        async with session.get(f"{tenant.GLPI_API_URL}/search/{itemtype}", headers=headers, params=params) as response:
+            record_upstream_status(glpi_breaker(), response.status)
+            if response.status in (200, 206):
+                data = await response.json()
+                items = [_normalize_search_row(row, fields) for row in data.get("data", [])]
+                logger.info(f"Retrieved {len(items)} {description} from GLPI")
+                return items
+            elif response.status == 401:  # Session expired/invalid
+                logger.warning("GLPI session expired, need to re-authenticate")
+                return None
+            else:
+                error_text = await response.text()
+                logger.error(
+                    f"Error searching {itemtype}: {response.status}, {error_text}"
+                )
+                return []
+    except Exception as e:
+        logger.error(f"Error searching {itemtype}: {e}")
+        glpi_breaker().record_failure()
+        return []
+
+# Query search/Ticket for tickets whose ID is above after_id, sorted by ID
+async def search_glpi_tickets(session_token, after_id=0, order="ASC", limit=GLPI_SEARCH_RANGE):
+    params = {
+        "criteria[0][field]": "2",
+        "criteria[0][searchtype]": "morethan",
+        "criteria[0][value]": str(after_id),
+        "sort": "2",
+        "order": order,
+        "range": f"0-{limit - 1}",
+    }
+    return await _search_glpi(
+        session_token, "Ticket", params, GLPI_TICKET_SEARCH_FIELDS, f"tickets above ID {after_id}"
+    )
+
+GLPI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _shift_glpi_date(value, seconds):
+    date = datetime.datetime.strptime(value, GLPI_DATE_FORMAT) + datetime.timedelta(seconds=seconds)
+    return date.strftime(GLPI_DATE_FORMAT)
+
+# Query search/Ticket for tickets modified after `since` (every ticket when None), ordered by
+# date_mod then ID. Sorting on several columns needs GLPI 10
+async def search_changed_glpi_tickets(session_token, since=None, order="ASC", limit=GLPI_SEARCH_RANGE):
+    params = {
+        "sort[0]": "19",
+        "sort[1]": "2",
+        "order[0]": order,
+        "order[1]": order,
+        "range": f"0-{limit - 1}",
+    }
+    if since is not None:
+        params.update({
+            "criteria[0][field]": "19",
+            "criteria[0][searchtype]": "morethan",
+            "criteria[0][value]": since,
+        })
+    return await _search_glpi(
+        session_token, "Ticket", params, GLPI_TICKET_SEARCH_FIELDS, f"tickets modified after {since}"
+    )
+
+# Look up tickets by ID with one search/Ticket request per GLPI_ID_BATCH IDs, keyed by ID
+async def fetch_glpi_tickets_by_id(session_token, ticket_ids):
+    ticket_ids = sorted(ticket_ids)
+    tickets = {}
+    for start in range(0, len(ticket_ids), GLPI_ID_BATCH):
+        batch = ticket_ids[start:start + GLPI_ID_BATCH]
+        params = {"range": f"0-{len(batch) - 1}"}
+        for i, ticket_id in enumerate(batch):
+            if i:
+                params[f"criteria[{i}][link]"] = "OR"
+            params[f"criteria[{i}][field]"] = "2"
+            params[f"criteria[{i}][searchtype]"] = "equals"
+            params[f"criteria[{i}][value]"] = str(ticket_id)
+        rows = await _search_glpi(
+            session_token, "Ticket", params, GLPI_TICKET_SEARCH_FIELDS, f"tickets out of {len(batch)} IDs"
+        )
+        if rows is None:
+            return None
+        tickets.update((row["id"], row) for row in rows if "id" in row)
+    return tickets
+
+# Read tickets by ID as GET /Ticket returns them, with one getMultipleItems request per
+# GLPI_ID_BATCH IDs, keyed by ID. Returns None when the session expired
+async def fetch_multiple_glpi_tickets(session_token, ticket_ids):
+    tenant = current_tenant()
+    ticket_ids = sorted(ticket_ids)
+    tickets = {}
+    try:
+        headers = {
+            "Session-Token": session_token,
+            "Content-Type": "application/json",
+            "App-Token": tenant.GLPI_APP_TOKEN,
+        }
+        session = get_http_session("glpi")
+        for start in range(0, len(ticket_ids), GLPI_ID_BATCH):
+            batch = ticket_ids[start:start + GLPI_ID_BATCH]
+            params = {}
+            for i, ticket_id in enumerate(batch):
+                params[f"items[{i}][itemtype]"] = "Ticket"
+                params[f"items[{i}][items_id]"] = str(ticket_id)
+            async with session.get(
+                f"{tenant.GLPI_API_URL}/getMultipleItems", headers=headers, params=params
+            ) as response:
+                record_upstream_status(glpi_breaker(), response.status)
                 if response.status in (200, 206):
                     data = await response.json()
-                    if isinstance(data, list):
-                        tickets = data
-                    else:
-                        tickets = data.get("data", [])
-                    logger.info(f"Retrieved {len(tickets)} tickets from GLPI")
-                    return tickets
+                    for ticket in data if isinstance(data, list) else []:
+                        if isinstance(ticket, dict) and "id" in ticket:
+                            ticket["id"] = int(ticket["id"])
+                            tickets[ticket["id"]] = ticket
                 elif response.status == 401:  # Session expired/invalid
                     logger.warning("GLPI session expired, need to re-authenticate")
                     return None
                 else:
+                    # Tickets left out are announced without their name and routed as unknown
                     error_text = await response.text()
                     logger.error(
-                        f"Error fetching tickets: {response.status}, {error_text}"
+                        f"Error fetching {len(batch)} tickets by ID: {response.status}, {error_text}"
                     )
-                    return []
     except Exception as e:
-        logger.error(f"Error fetching tickets: {e}")
-        return []
+        logger.error(f"Error fetching tickets by ID: {e}")
+        glpi_breaker().record_failure()
+    return tickets
+
+# Read the change feed from `cursor`, the (date_mod, ID) of the last change read. The last
+# GLPI_CHANGE_OVERLAP seconds are read again to catch changes committed late with an older
+# date_mod, the pipeline drops whatever it already announced
+async def fetch_changed_glpi_tickets(session_token, cursor):
+    since = _shift_glpi_date(cursor[0], -GLPI_CHANGE_OVERLAP)
+    position = ("", 0)
+    limit = GLPI_SEARCH_RANGE
+    changed = []
+    while True:
+        page = await search_changed_glpi_tickets(session_token, since, limit=limit)
+        if page is None:
+            return None
+        fresh = [ticket for ticket in page if (ticket.get("date_mod") or "", ticket["id"]) > position]
+        changed.extend(fresh)
+        if len(page) < limit:
+            return changed
+        if fresh:
+            # date_mod has a one second resolution: restart at the second of the last row read and
+            # let the ID tiebreak skip the rows of that second already read
+            position = (fresh[-1]["date_mod"], fresh[-1]["id"])
+            since = _shift_glpi_date(position[0], -1)
+            limit = GLPI_SEARCH_RANGE
+        else:
+            # More changes in one second than a page holds
+            limit *= 2
+
+# Tickets already handled: every ID up to the watermark counts as seen, except inside the last
+# `window` IDs where a ring bitmap records which ones were really seen, so late-visible tickets still show up
+class SeenTickets:
+    def __init__(self, window=None):
+        window = SEEN_WINDOW if window is None else window
+        self.window = max(8, (window + 7) // 8 * 8)
+        self.watermark = 0
+        self._bits = bytearray(self.window // 8)
+
+    def __contains__(self, ticket_id):
+        if ticket_id > self.watermark:
+            return False
+        if ticket_id <= self.watermark - self.window:
+            return True
+        slot = ticket_id % self.window
+        return bool(self._bits[slot >> 3] & (1 << (slot & 7)))
+
+    def add(self, ticket_id):
+        if ticket_id <= self.watermark - self.window:
+            return
+        if ticket_id > self.watermark:
+            if ticket_id - self.watermark >= self.window:
+                self._bits = bytearray(len(self._bits))
+            else:
+                # Slots being reused for the new IDs still hold bits from IDs that fell out of the window
+                for old_id in range(self.watermark + 1, ticket_id + 1):
+                    slot = old_id % self.window
+                    self._bits[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+            self.watermark = ticket_id
+        slot = ticket_id % self.window
+        self._bits[slot >> 3] |= 1 << (slot & 7)
+
+    # Count every ID up to ticket_id as seen, e.g. when starting from the newest existing ticket
+    def advance_to(self, ticket_id):
+        if ticket_id >= self.watermark:
+            self.watermark = ticket_id
+            self._bits = bytearray(b"\xff" * len(self._bits))
+            return
+        for old_id in range(max(1, self.watermark - self.window + 1), ticket_id + 1):
+            slot = old_id % self.window
+            self._bits[slot >> 3] |= 1 << (slot & 7)
+
+# Ticket keys holding each watched field: GET /Ticket columns first, then the search/Ticket names
+TRACKED_FIELDS = {
+    "status": ("status",),
+    "assignee": ("users_id_assign", "assignee"),
+    "priority": ("priority",),
+}
+
+# Highest ticket ID (and fingerprint) that fits a signed 64-bit integer
+MAX_TICKET_ID = 2 ** 63 - 1
+
+# 63-bit hash of the watched fields (so it fits SQLite's signed integers), 0 when the ticket row
+# carries none of them
+def ticket_fingerprint(ticket):
+    values = []
+    for keys in TRACKED_FIELDS.values():
+        value = next((ticket[key] for key in keys if ticket.get(key) is not None), None)
+        values.append("" if value is None else str(value))
+    if not any(values):
+        return 0
+    digest = hashlib.blake2b("\x1f".join(values).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") & MAX_TICKET_ID or 1
+
+# Last fingerprint of each tracked ticket, as sorted ID and hash arrays: 16 bytes per ticket
+# whatever the IDs, and new IDs, being the highest so far, are appended. Changes since the last
+# save are kept aside so only those rows are written back
+class TicketFingerprints:
+    def __init__(self, rows=()):
+        self._ids = array.array("q")
+        self._hashes = array.array("q")
+        for ticket_id, fingerprint in rows:
+            self._ids.append(ticket_id)
+            self._hashes.append(fingerprint)
+        self._changed = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, ticket_id):
+        index = bisect.bisect_left(self._ids, ticket_id)
+        if index < len(self._ids) and self._ids[index] == ticket_id:
+            return self._hashes[index]
+        return 0
+
+    # Store a fingerprint and return the previous one
+    def update(self, ticket_id, fingerprint):
+        if not 0 < ticket_id <= MAX_TICKET_ID:
+            raise ValueError(f"invalid ticket ID {ticket_id}")
+        index = bisect.bisect_left(self._ids, ticket_id)
+        if index < len(self._ids) and self._ids[index] == ticket_id:
+            previous = self._hashes[index]
+            self._hashes[index] = fingerprint
+        else:
+            previous = 0
+            self._ids.insert(index, ticket_id)
+            self._hashes.insert(index, fingerprint)
+        if previous != fingerprint:
+            self._changed[ticket_id] = fingerprint
+        return previous
+
+    # (ticket ID, fingerprint) rows changed since the last call
+    def pop_changes(self):
+        changes, self._changed = list(self._changed.items()), {}
+        return changes
 
-async def send_matrix_message(message):
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+def _parse_days(spec):
+    if spec == "*":
+        return set(range(7))
+    days = set()
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = (DAY_NAMES.index(d) for d in part.split("-"))
+            day = first
+            days.add(day)
+            while day != last:
+                day = (day + 1) % 7
+                days.add(day)
+        else:
+            days.add(DAY_NAMES.index(part))
+    return days
+
+def _parse_minutes(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+# Parse POLL_WINDOWS entries "<days> <HH:MM>-<HH:MM> <min>-<max>" separated by ";"
+def parse_poll_windows(spec):
+    windows = []
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        days, hours, bounds = entry.lower().split()
+        start, end = hours.split("-")
+        low, high = bounds.split("-")
+        windows.append((_parse_days(days), _parse_minutes(start), _parse_minutes(end), float(low), float(high)))
+    return windows
+
+# Choose how long to wait before the next poll from the ticket arrival rate, within the bounds of
+# the current time window: roughly POLL_TARGET_TICKETS new tickets are expected per poll
+class PollScheduler:
+    def __init__(self, min_interval=None, max_interval=None, windows=None, jitter=None):
+        self.min_interval = POLL_INTERVAL_MIN if min_interval is None else min_interval
+        self.max_interval = POLL_INTERVAL_MAX if max_interval is None else max_interval
+        self.windows = parse_poll_windows(POLL_WINDOWS) if windows is None else windows
+        self.jitter = POLL_JITTER if jitter is None else jitter
+        self.rate = 0.0
+        self.last_poll = None
+
+    def bounds(self, now=None):
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        weekday = now.weekday()
+        for days, start, end, low, high in self.windows:
+            if start <= end:
+                active = weekday in days and start <= minute < end
+            else:
+                # Window running past midnight belongs to the day it started on
+                active = (weekday in days and minute >= start) or ((weekday - 1) % 7 in days and minute < end)
+            if active:
+                return low, high
+        return self.min_interval, self.max_interval
+
+    def next_interval(self, new_count, now=None):
+        current = time.monotonic()
+        if self.last_poll is not None and current > self.last_poll:
+            sample = new_count / (current - self.last_poll)
+            self.rate = 0.5 * sample + 0.5 * self.rate
+        self.last_poll = current
+        low, high = self.bounds(now)
+        interval = high if self.rate <= 0 else POLL_TARGET_TICKETS / self.rate
+        interval = min(high, max(low, interval))
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+# Persist notifier state in a small SQLite file so a restart resumes from the last watermark
+class StateStore:
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            "name TEXT PRIMARY KEY, window INTEGER, watermark INTEGER, bits BLOB)"
+        )
+        # One row per ticket, so a poll only writes the fingerprints that changed
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ticket_fingerprints ("
+            "name TEXT, id INTEGER, hash INTEGER, PRIMARY KEY (name, id))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS feed (name TEXT PRIMARY KEY, date_mod TEXT, id INTEGER)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS poll (name TEXT PRIMARY KEY, watermark INTEGER)"
+        )
+        self._db.commit()
+
+    def load_seen(self, name="tickets"):
+        row = self._db.execute(
+            "SELECT window, watermark, bits FROM seen WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        seen = SeenTickets(window=row[0])
+        seen.watermark = row[1]
+        seen._bits = bytearray(row[2])
+        return seen
+
+    def save_seen(self, seen, name="tickets"):
+        self._db.execute(
+            "INSERT OR REPLACE INTO seen (name, window, watermark, bits) VALUES (?, ?, ?, ?)",
+            (name, seen.window, seen.watermark, bytes(seen._bits)),
+        )
+        self._db.commit()
+
+    def load_fingerprints(self, name="tickets"):
+        rows = self._db.execute(
+            "SELECT id, hash FROM ticket_fingerprints WHERE name = ? ORDER BY id", (name,)
+        ).fetchall()
+        return TicketFingerprints(rows) if rows else None
+
+    def save_fingerprints(self, changes, name="tickets"):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO ticket_fingerprints (name, id, hash) VALUES (?, ?, ?)",
+            [(name, ticket_id, fingerprint) for ticket_id, fingerprint in changes],
+        )
+        self._db.commit()
+
+    # Position of the date_mod change feed, as (date_mod, ticket ID)
+    def load_cursor(self, name="tickets"):
+        row = self._db.execute(
+            "SELECT date_mod, id FROM feed WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else tuple(row)
+
+    def save_cursor(self, cursor, name="tickets"):
+        self._db.execute(
+            "INSERT OR REPLACE INTO feed (name, date_mod, id) VALUES (?, ?, ?)",
+            (name, cursor[0], cursor[1]),
+        )
+        self._db.commit()
+
+    # Highest ticket ID read by the poller itself
+    def load_poll_watermark(self, name="tickets"):
+        row = self._db.execute(
+            "SELECT watermark FROM poll WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def save_poll_watermark(self, watermark, name="tickets"):
+        self._db.execute(
+            "INSERT OR REPLACE INTO poll (name, watermark) VALUES (?, ?)", (name, watermark)
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+# Append-only log of outgoing notifications: an "add" line when one is queued, an "ack" line once
+# Matrix accepted it. Only acknowledged transaction IDs are kept in memory, and only until compaction
+class NotificationJournal:
+    def __init__(self, path, compact_every=None):
+        self.path = path
+        self.compact_every = JOURNAL_COMPACT_EVERY if compact_every is None else compact_every
+        self._acks = 0
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, notification):
+        self._file.write(json.dumps({"add": list(notification)}) + "\n")
+
+    def ack(self, txn_id):
+        self._file.write(json.dumps({"ack": txn_id}) + "\n")
+        self._acks += 1
+
+    # Write buffered lines to disk in one fsync, compacting once enough acks piled up
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._acks >= self.compact_every:
+            self.compact()
+
+    def _entries(self):
+        with open(self.path, encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Torn last line after a crash
+                    continue
+
+    # Notifications added but never acknowledged, oldest first
+    def pending(self):
+        self._file.flush()
+        acked = set(entry["ack"] for entry in self._entries() if "ack" in entry)
+        for entry in self._entries():
+            if "add" in entry and entry["add"][2] not in acked:
+                yield tuple(entry["add"])
+
+    def compact(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+            for notification in self.pending():
+                tmp_file.write(json.dumps({"add": list(notification)}) + "\n")
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._acks = 0
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+# Index a poll result by integer ticket ID and collect the tickets missing from seen_ids, in one pass
+def diff_new_tickets(tickets, seen_ids):
+    index = {}
+    new_tickets = []
+    for ticket in tickets:
+        if "id" not in ticket:
+            continue
+        ticket_id = int(ticket["id"])
+        if ticket_id in index:
+            continue
+        index[ticket_id] = ticket
+        if ticket_id not in seen_ids:
+            new_tickets.append(ticket)
+    return index, new_tickets
+
+# Token bucket pacing requests to one upstream. A 429 pauses every sender and lowers the rate a little,
+# each `recovery` seconds without one raise it again, up to the configured rate
+class TokenBucket:
+    def __init__(self, rate, burst, recovery=60.0):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = rate / 10
+        self.recovery = recovery
+        self.limited_at = 0.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now > self.updated:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        if self.rate < self.max_rate and now - self.limited_at >= self.recovery:
+                            self.rate = min(self.max_rate, self.rate / 0.9)
+                            self.limited_at = now
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        # Only the retried request goes out when the pause ends, the rest is paced again
+        self.tokens = min(self.tokens, 1.0)
+        self.updated = self.blocked_until
+        self.rate = max(self.min_rate, self.rate * 0.9)
+        self.limited_at = self.blocked_until
+
+_matrix_buckets = {}
+
+def get_matrix_bucket(homeserver):
+    bucket = _matrix_buckets.get(homeserver)
+    if bucket is None:
+        bucket = TokenBucket(MATRIX_RATE, MATRIX_BURST)
+        _matrix_buckets[homeserver] = bucket
+    return bucket
+
+# Read how long the homeserver wants us to wait from a 429 (M_LIMIT_EXCEEDED) response, in seconds
+async def _matrix_retry_after(response):
     try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            txn_id = int(time.time() * 1000)
-            url = f"{MATRIX_HOMESERVER}/_matrix/client/v3/rooms/{ROOM_ID}/send/m.room.message/{txn_id}"
-            headers = {
-                "Authorization": f"Bearer {MATRIX_TOKEN}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "msgtype": "m.text",
-                "body": message
-            }
+        data = await response.json(content_type=None)
+        if isinstance(data, dict) and data.get("retry_after_ms") is not None:
+            return int(data["retry_after_ms"]) / 1000
+    except Exception:
+        pass
+    try:
+        return float(response.headers.get("Retry-After", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+# Random per-process prefix so transaction IDs never clash with a previous run's
+MATRIX_TXN_NONCE = os.urandom(6).hex()
+_matrix_txn_counter = itertools.count(1)
+
+# Build a transaction ID from what the message is about, so retries of the same event are
+# deduplicated by the homeserver while distinct events can be sent in parallel
+def matrix_txn_id(ticket_id=None, kind="created", room_id=None):
+    prefix = f"glpi-{MATRIX_TXN_NONCE}"
+    name = current_tenant().name
+    if name is not None:
+        # Tenants sharing a bot account have their own ticket 42, keep their IDs apart
+        prefix += "-" + re.sub(r"[^A-Za-z0-9._~]", "_", name)
+    if ticket_id is None:
+        return f"{prefix}-{kind}-n{next(_matrix_txn_counter)}"
+    if room_id is not None:
+        # A routed ticket is announced in several rooms, each copy is journaled and acked on its own
+        room_hash = hashlib.sha1(room_id.encode()).hexdigest()[:8]
+        return f"{prefix}-{kind}-{ticket_id}-{room_hash}"
+    return f"{prefix}-{kind}-{ticket_id}"
+
+# Returns True once sent, None when the homeserver rejected this message for good (400 bad event,
+# 403 not allowed in the room, 413 too large) and False for anything worth retrying
+async def send_matrix_message(message, txn_id=None, room_id=None):
+    tenant = current_tenant()
+    if not matrix_breaker().allow():
+        return False
+    try:
+        room_id = room_id or tenant.ROOM_ID
+        session = get_http_session("matrix")
+        bucket = get_matrix_bucket(tenant.MATRIX_HOMESERVER)
+        if txn_id is None:
+            txn_id = matrix_txn_id()
+        url = f"{tenant.MATRIX_HOMESERVER}/_matrix/client/v3/rooms/{room_id}/send/m.room.message/{txn_id}"
+        headers = {
+            "Authorization": f"Bearer {tenant.MATRIX_TOKEN}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "msgtype": "m.text",
+            "body": message
+        }
+        for attempt in range(MATRIX_MAX_RETRIES + 1):
+            await bucket.acquire()
             async with session.put(url, headers=headers, json=payload) as response:
+                record_upstream_status(matrix_breaker(), response.status)
                 if response.status in (200, 201):
                     logger.info(f"Message sent: {message}")
                     return True
+                elif response.status == 429:
+                    retry_after = await _matrix_retry_after(response)
+                    logger.warning(f"Matrix rate limit hit, retrying in {retry_after:.1f}s")
+                    bucket.pause(retry_after)
                 else:
                     error_response = await response.text()
                     logger.error(f"Failed to send message. Status: {response.status}, Response: {error_response}")
+                    if response.status in (400, 403, 413):
+                        return None
+                    if response.status == 401:
+                        # Expired or rotated token: keep the messages and back off until it is replaced
+                        matrix_breaker().record_failure()
                     return False
+        logger.error(f"Failed to send message after {MATRIX_MAX_RETRIES} rate-limited retries")
+        return False
     except Exception as e:
         logger.error(f"Error sending Matrix message: {e}")
+        matrix_breaker().record_failure()
         return False
 
-async def monitor_glpi_tickets():
-    session_token = init_glpi_session()
-    if not session_token:
-        logger.error("Unable to initialize GLPI session. Stopping.")
+# Send (room_id, message, txn_id) notifications with at most MATRIX_SEND_CONCURRENCY requests
+# in flight. With MATRIX_ROOM_ORDERING each room is drained in order by a single lane
+async def deliver_matrix_messages(notifications):
+    semaphore = asyncio.Semaphore(MATRIX_SEND_CONCURRENCY)
+    results = [False] * len(notifications)
+
+    async def send(index):
+        room_id, message, txn_id = notifications[index]
+        async with semaphore:
+            results[index] = await send_matrix_message(message, txn_id, room_id=room_id)
+
+    if MATRIX_ROOM_ORDERING:
+        lanes = {}
+        for index, (room_id, _, _) in enumerate(notifications):
+            lanes.setdefault(room_id, []).append(index)
+
+        async def drain(indexes):
+            for index in indexes:
+                await send(index)
+                if results[index] is False:
+                    # Later messages of the room wait for this one, they stay unsent until the retry
+                    break
+
+        await asyncio.gather(*(drain(indexes) for indexes in lanes.values()))
+    else:
+        await asyncio.gather(*(send(index) for index in range(len(notifications))))
+    return results
+
+# Collapse notifications into one message per room
+def build_digests(notifications):
+    tenant = current_tenant()
+    rooms = {}
+    for room_id, message, _ in notifications:
+        if tenant.MESSAGE and message.startswith(tenant.MESSAGE):
+            message = message[len(tenant.MESSAGE):].strip()
+        rooms.setdefault(room_id, []).append(message)
+    digests = []
+    for room_id, messages in rooms.items():
+        lines = [f"- {m}" for m in messages[:DIGEST_MAX_LINES]]
+        if len(messages) > DIGEST_MAX_LINES:
+            lines.append(f"- ... and {len(messages) - DIGEST_MAX_LINES} more")
+        header = f"{tenant.MESSAGE} {len(messages)} new notifications" if tenant.MESSAGE else f"{len(messages)} new notifications"
+        digests.append((room_id, header + "\n" + "\n".join(lines), matrix_txn_id(kind="digest")))
+    return digests
+
+# Digest IDs are the only ones ending in "-digest-n<counter>": ticket IDs end in the ticket ID or a
+# room hash, and the tenant name sits in the prefix, so a tenant called "eu-digest" cannot match
+def _is_digest(notification):
+    return re.search(r"-digest-n\d+$", notification[2]) is not None
+
+# Replace the notifications of every room with at least DIGEST_THRESHOLD of them in the batch by a
+# single digest at the position of the first one. Returns the new batch and (digest, replaced) pairs
+def coalesce_notifications(batch):
+    if DIGEST_THRESHOLD <= 0:
+        return batch, []
+    rooms = {}
+    for notification in batch:
+        if not _is_digest(notification):
+            rooms.setdefault(notification[0], []).append(notification)
+    rooms = {room_id: items for room_id, items in rooms.items() if len(items) >= DIGEST_THRESHOLD}
+    if not rooms:
+        return batch, []
+    coalesced = []
+    replaced = []
+    for notification in batch:
+        items = rooms.get(notification[0])
+        if items is None or _is_digest(notification):
+            coalesced.append(notification)
+        elif notification is items[0]:
+            digest = build_digests(items)[0]
+            coalesced.append(digest)
+            replaced.append((digest, items))
+    return coalesced, replaced
+
+# Hand a notification to the sender, applying MATRIX_QUEUE_POLICY when the queue is full
+async def enqueue_notification(queue, notification, journal=None):
+    if not queue.full() or MATRIX_QUEUE_POLICY == "block":
+        await queue.put(notification)
         return
+    if MATRIX_QUEUE_POLICY == "drop_oldest":
+        dropped = queue.get_nowait()
+        queue.task_done()
+        logger.warning(f"Notification queue full, dropping: {dropped[1]}")
+        if journal:
+            journal.ack(dropped[2])
+        queue.put_nowait(notification)
+    else:
+        pending = []
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+            queue.task_done()
+        pending.append(notification)
+        logger.warning(f"Notification queue full, collapsing {len(pending)} notifications into a digest")
+        digests = build_digests(pending)
+        if journal:
+            for digest in digests:
+                journal.append(digest)
+            for collapsed in pending:
+                journal.ack(collapsed[2])
+            journal.flush()
+        for digest in digests:
+            queue.put_nowait(digest)
+
+# Queue the notifications a previous run left undelivered. The backlog is read in full first:
+# enqueueing can write digests and acks to the same journal, which must not be replayed again
+async def replay_journal(queue, journal):
+    pending = list(journal.pending())
+    for notification in pending:
+        await enqueue_notification(queue, notification, journal)
+    return len(pending)
+
+# Consume the notification queue, sending whatever has piled up as one batch. With a journal,
+# failed notifications are retried (ahead of newer ones) until Matrix accepts them
+async def run_matrix_sender(queue, journal=None):
+    batch = []
+    # Queue items each batch entry stands for, when a digest replaced several of them
+    weights = {}
+    while True:
+        if not batch:
+            batch.append(await queue.get())
+            if DIGEST_WINDOW > 0:
+                await asyncio.sleep(DIGEST_WINDOW)
+        while not queue.empty() and len(batch) < MATRIX_QUEUE_SIZE:
+            batch.append(queue.get_nowait())
+        batch, replaced = coalesce_notifications(batch)
+        for digest, items in replaced:
+            weights[digest[2]] = sum(weights.pop(item[2], 1) for item in items)
+            logger.info(f"Coalesced {len(items)} notifications into one digest")
+            if journal:
+                journal.append(digest)
+                for item in items:
+                    journal.ack(item[2])
+        if journal and replaced:
+            journal.flush()
+        try:
+            results = await deliver_matrix_messages(batch)
+        except Exception as e:
+            logger.error(f"Error delivering Matrix messages: {e}")
+            results = [False] * len(batch)
+        stats["sent"] += sum(1 for sent in results if sent)
+        failed = []
+        for notification, sent in zip(batch, results):
+            if sent is None:
+                stats["rejected"] += 1
+                logger.error(f"Matrix rejected the notification for {notification[0]}, dropping it")
+            # Sent or rejected for good, either way it is not retried
+            done = sent is not False
+            if done and journal:
+                journal.ack(notification[2])
+            if done or journal is None:
+                for _ in range(weights.pop(notification[2], 1)):
+                    queue.task_done()
+            else:
+                failed.append(notification)
+        if journal:
+            journal.flush()
+        batch = failed
+        if failed:
+            stats["send_failures"] += len(failed)
+            delay = matrix_breaker().retry_delay()
+            logger.warning(f"{len(failed)} notifications not delivered, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+def is_announced_subitem(item):
+    return item.get("itemtype", "Ticket") == "Ticket" and not int(item.get("is_private") or 0)
+
+# Plain-text start of a sub-item's content, which GLPI stores as escaped HTML
+def subitem_excerpt(content):
+    text = re.sub(r"<[^>]*>", " ", html.unescape(content or ""))
+    text = " ".join(html.unescape(text).split())
+    if len(text) > SUBITEM_EXCERPT_LENGTH:
+        text = text[:SUBITEM_EXCERPT_LENGTH - 1].rstrip() + "…"
+    return text
+
+# Announce the follow-ups, tasks or solutions added since the last poll, returning how many were
+# queued. New rows come from the newest-first listing of the itemtype, and their tickets are looked
+# up in batches rather than one request per ticket, in the shape the ticket poller routes on
+async def poll_glpi_subitems(session_token, pipeline, itemtype):
+    seen = pipeline.items_seen(itemtype)
+    if seen is None:
+        # Start from the newest existing item instead of announcing them all. An empty listing
+        # is a table without items yet, a failed one must not seed from 0
+        _, items = await _fetch_newest_glpi_page(session_token, itemtype, 1)
+        if items is not None:
+            pipeline.seed_items(itemtype, items)
+        return 0
+    items = await fetch_new_glpi_items_window(session_token, itemtype, seen)
+    if not items:
+        return 0
+    ticket_key = SUBITEM_TICKET_KEYS[itemtype]
+    ticket_ids = {int(item[ticket_key]) for item in items if is_announced_subitem(item)}
+    if not ticket_ids:
+        tickets = {}
+    elif current_tenant().GLPI_FETCH_MODE in ("search", "changes"):
+        tickets = await fetch_glpi_tickets_by_id(session_token, ticket_ids)
+    else:
+        tickets = await fetch_multiple_glpi_tickets(session_token, ticket_ids)
+    if tickets is None:
+        return 0
+    return await pipeline.publish_items(itemtype, items, tickets)
+
+# Ticket keys holding each routing field: GET /Ticket columns first, then the search/Ticket names
+ROUTE_FIELDS = {
+    "entity": ("entities_id", "entity"),
+    "category": ("itilcategories_id", "category"),
+    "priority": ("priority",),
+    "type": ("type",),
+    "requester_group": ("requester_groups", "requester_group"),
+}
+# Separator GLPI's search engine puts between the values of a multi-valued column
+GLPI_SEARCH_VALUE_SEPARATOR = "$$##$$"
 
-    previous_tickets = set()
-    error_count = 0
-    max_errors = 5
+def _route_values(ticket, field):
+    for key in ROUTE_FIELDS[field]:
+        value = ticket.get(key)
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            return [str(item) for item in value]
+        return str(value).split(GLPI_SEARCH_VALUE_SEPARATOR)
+    return []
+
+# Routes compiled into one bitset per field value: bit n is set when route n accepts that value.
+# A ticket's routes are the AND over fields of the bitsets of its values, OR'd with the routes
+# that leave the field open, so matching costs one lookup per field whatever the number of routes
+class RoutingTable:
+    def __init__(self, routes):
+        self.rooms = []
+        self.index = {field: {} for field in ROUTE_FIELDS}
+        self.open_routes = dict.fromkeys(ROUTE_FIELDS, 0)
+        for bit, route in enumerate(routes):
+            match = route.get("match", {})
+            unknown = set(match) - set(ROUTE_FIELDS)
+            if unknown:
+                raise ValueError(f"unknown route fields {', '.join(sorted(unknown))}")
+            self.rooms.append(route["room"])
+            for field in ROUTE_FIELDS:
+                values = match.get(field)
+                if values is None:
+                    self.open_routes[field] |= 1 << bit
+                    continue
+                for value in values if isinstance(values, list) else [values]:
+                    by_value = self.index[field]
+                    by_value[str(value)] = by_value.get(str(value), 0) | 1 << bit
+        self.all_routes = (1 << len(self.rooms)) - 1
+        # Fields no route looks at cost nothing per ticket
+        self.fields = [field for field in ROUTE_FIELDS if self.index[field]]
+
+    def __len__(self):
+        return len(self.rooms)
+
+    # Rooms of every route matching the ticket, in route order and without duplicates
+    def rooms_for(self, ticket):
+        matched = self.all_routes
+        for field in self.fields:
+            by_value = self.index[field]
+            accepted = self.open_routes[field]
+            for value in _route_values(ticket, field):
+                accepted |= by_value.get(value, 0)
+            matched &= accepted
+            if not matched:
+                return []
+        rooms = []
+        while matched:
+            lowest = matched & -matched
+            room = self.rooms[lowest.bit_length() - 1]
+            if room not in rooms:
+                rooms.append(room)
+            matched ^= lowest
+        return rooms
+
+_routing_tables = {}
+
+# Read {"routes": [{"room": "!room:server", "match": {"entity": [1, 2], "priority": [5, 6]}}, ...]}.
+# A route matches when every field it lists has one of the given values. Tables are compiled once
+# per file, so tenants sharing a routes file share its index
+def load_routing_table(path):
+    table = _routing_tables.get(path)
+    if table is None:
+        with open(path, encoding="utf-8") as routes_file:
+            data = json.load(routes_file)
+        table = RoutingTable(data.get("routes", []) if isinstance(data, dict) else data)
+        _routing_tables[path] = table
+    return table
+
+# Shared by the poller and the webhook receiver: turns new tickets into journaled, queued
+# notifications and remembers them so the other source does not announce them again
+class TicketPipeline:
+    def __init__(self, queue, store=None, journal=None):
+        # Webhook handlers run outside the tenant's task, so keep the tenant at hand
+        self.tenant = current_tenant()
+        self.queue = queue
+        self.store = store
+        self.journal = journal
+        self.routing = load_routing_table(self.tenant.ROUTES_FILE) if self.tenant.ROUTES_FILE else None
+        self.seen = store.load_seen(self.tenant.state_key) if store else None
+        self.resumed = self.seen is not None
+        if self.seen is None:
+            self.seen = SeenTickets()
+        self.fingerprints = store.load_fingerprints(self.tenant.state_key) if store else None
+        if self.fingerprints is None:
+            self.fingerprints = TicketFingerprints()
+        self.cursor = store.load_cursor(self.tenant.state_key) if store else None
+        # Webhooks move seen.watermark ahead of what polling read, so the reconciliation poll
+        # follows its own watermark to still catch the tickets whose webhook was missed
+        self.poll_watermark = store.load_poll_watermark(self.tenant.state_key) if store else None
+        if self.poll_watermark is None:
+            self.poll_watermark = self.seen.watermark
+        self._items_seen = {}
+
+    # Remember tickets without announcing them, returning how many there were
+    def mark_seen(self, tickets):
+        index, _ = diff_new_tickets(tickets, ())
+        for ticket_id in index:
+            self.seen.add(ticket_id)
+        changed = self._fingerprint(index.values())
+        if self.store and index:
+            self.store.save_seen(self.seen, self.tenant.state_key)
+        if self.store and changed:
+            self.store.save_fingerprints(self.fingerprints.pop_changes(), self.tenant.state_key)
+        return len(index)
+
+    # Start from the newest existing tickets: every ID up to the highest one counts as seen
+    def seed(self, tickets):
+        ticket_ids = [int(ticket_info["id"]) for ticket_info in tickets if "id" in ticket_info]
+        if ticket_ids:
+            self.seen.advance_to(max(ticket_ids))
+        self.move_poll_watermark(tickets)
+        return self.mark_seen(tickets)
+
+    # Record the highest ticket ID among rows read by the poller
+    def move_poll_watermark(self, tickets):
+        highest = max((int(ticket_info["id"]) for ticket_info in tickets if "id" in ticket_info), default=0)
+        if highest > self.poll_watermark:
+            self.poll_watermark = highest
+            if self.store:
+                self.store.save_poll_watermark(highest, self.tenant.state_key)
+
+    # Record the fingerprint of each ticket, returning those whose watched fields changed
+    def _fingerprint(self, tickets):
+        if not self.tenant.TRACK_CHANGES:
+            return []
+        changed = []
+        for ticket_info in tickets:
+            fingerprint = ticket_fingerprint(ticket_info)
+            if fingerprint and 0 < int(ticket_info["id"]) <= MAX_TICKET_ID:
+                previous = self.fingerprints.update(int(ticket_info["id"]), fingerprint)
+                if previous != fingerprint:
+                    changed.append((ticket_info, previous))
+        return changed
+
+    # One notification per room the ticket is routed to, ROOM_ID when no route matches
+    def _notifications(self, ticket_info, message, kind="created", item_id=None):
+        item_id = ticket_info["id"] if item_id is None else item_id
+        rooms = self.routing.rooms_for(ticket_info) if self.routing else []
+        if not rooms:
+            return [(self.tenant.ROOM_ID, message, matrix_txn_id(item_id, kind))]
+        return [(room_id, message, matrix_txn_id(item_id, kind, room_id)) for room_id in rooms]
+
+    def _journal(self, notifications):
+        if self.journal and notifications:
+            for notification in notifications:
+                self.journal.append(notification)
+            self.journal.flush()
+
+    async def _enqueue(self, notifications):
+        for notification in notifications:
+            await enqueue_notification(self.queue, notification, self.journal)
+
+    def _update_message(self, ticket_info):
+        details = []
+        status = ticket_info.get("status")
+        if status is not None:
+            details.append(f"status: {GLPI_TICKET_STATUSES.get(int(status), status)}")
+        assignee = next((ticket_info[key] for key in TRACKED_FIELDS["assignee"] if ticket_info.get(key)), None)
+        if assignee is not None:
+            details.append(f"assigned to: {assignee}")
+        if ticket_info.get("priority") is not None:
+            details.append(f"priority: {ticket_info['priority']}")
+        suffix = f" - {', '.join(details)}" if details else ""
+        return f"{self.tenant.UPDATE_MESSAGE} {ticket_info.get('name', 'No name')} (ID: {ticket_info['id']}){suffix}"
+
+    # Announce the tickets not seen yet, and changes of the ones already known, returning how many
+    # notifications were queued
+    async def publish(self, tickets):
+        tenant = self.tenant
+        index, new_tickets = diff_new_tickets(tickets, self.seen)
+        notifications = []
+        for ticket_info in new_tickets:
+            message = f"{tenant.MESSAGE} {ticket_info.get('name', 'No name')} (ID: {ticket_info['id']})"
+            notifications.extend(self._notifications(ticket_info, message))
+        changed = self._fingerprint(index.values())
+        new_ids = {int(ticket_info["id"]) for ticket_info in new_tickets}
+        for ticket_info, previous in changed:
+            # New tickets and tickets fingerprinted for the first time have nothing to compare with
+            if previous and int(ticket_info["id"]) not in new_ids:
+                # The same state can come back (Solved, reopened, Solved), so the hash alone would
+                # repeat a transaction ID the homeserver still remembers: add when the change happened
+                changed_at = re.sub(r"\D", "", str(ticket_info.get("date_mod") or ""))
+                changed_at = changed_at or f"n{next(_matrix_txn_counter)}"
+                kind = f"updated-{changed_at}-{ticket_fingerprint(ticket_info):016x}"
+                notifications.extend(self._notifications(ticket_info, self._update_message(ticket_info), kind))
+        # Journal first, then move the watermark, so a crash in between only causes a resend
+        self._journal(notifications)
+        for ticket_info in new_tickets:
+            self.seen.add(int(ticket_info["id"]))
+        if self.store and new_tickets:
+            self.store.save_seen(self.seen, self.tenant.state_key)
+        if self.store and changed:
+            self.store.save_fingerprints(self.fingerprints.pop_changes(), self.tenant.state_key)
+        await self._enqueue(notifications)
+        return len(notifications)
+
+    # Seen IDs of a sub-item type, None until a first poll recorded where to start from
+    def items_seen(self, itemtype):
+        if itemtype not in self._items_seen:
+            key = f"{self.tenant.state_key}:{itemtype}"
+            self._items_seen[itemtype] = self.store.load_seen(key) if self.store else None
+        return self._items_seen[itemtype]
+
+    def mark_items_seen(self, itemtype, items):
+        seen = self.items_seen(itemtype) or SeenTickets()
+        for item in items:
+            seen.add(int(item["id"]))
+        self._items_seen[itemtype] = seen
+        if self.store:
+            self.store.save_seen(seen, f"{self.tenant.state_key}:{itemtype}")
+
+    # Start from the newest existing items of a type: every ID up to the highest one counts as seen
+    def seed_items(self, itemtype, items):
+        seen = SeenTickets()
+        if items:
+            seen.advance_to(max(int(item["id"]) for item in items))
+        self._items_seen[itemtype] = seen
+        self.mark_items_seen(itemtype, items)
+
+    # Announce new follow-ups, tasks or solutions of tickets, routed like their ticket. `tickets`
+    # maps ticket IDs to ticket rows; private items and items of changes or problems are skipped
+    async def publish_items(self, itemtype, items, tickets):
+        notifications = []
+        for item in items:
+            if not is_announced_subitem(item):
+                continue
+            ticket_id = int(item[SUBITEM_TICKET_KEYS[itemtype]])
+            ticket_info = tickets.get(ticket_id) or {"id": ticket_id}
+            message = (
+                f"{SUBITEM_MESSAGES[itemtype]} {ticket_info.get('name', 'No name')} (ID: {ticket_id})"
+                f": {subitem_excerpt(item.get('content'))}"
+            )
+            notifications.extend(self._notifications(ticket_info, message, itemtype.lower(), item["id"]))
+        self._journal(notifications)
+        self.mark_items_seen(itemtype, items)
+        await self._enqueue(notifications)
+        return len(notifications)
+
+    def move_cursor(self, cursor):
+        self.cursor = cursor
+        if self.store:
+            self.store.save_cursor(cursor, self.tenant.state_key)
+
+    # Announce rows of the change feed. Tickets created before the window being read were known
+    # already, they are only announced when their watched fields change
+    async def publish_changes(self, tickets):
+        since = _shift_glpi_date(self.cursor[0], -GLPI_CHANGE_OVERLAP)
+        existing = [
+            ticket_info for ticket_info in tickets
+            if int(ticket_info["id"]) not in self.seen and (ticket_info.get("date_creation") or "") <= since
+        ]
+        if existing:
+            self.mark_seen(existing)
+        count = await self.publish(tickets)
+        latest = max(((ticket_info.get("date_mod") or "", int(ticket_info["id"])) for ticket_info in tickets),
+                     default=self.cursor)
+        if latest > self.cursor:
+            self.move_cursor(latest)
+        return count
+
+# GLPI signs webhooks with HMAC-SHA256 over the body followed by the X-GLPI-timestamp header
+def verify_glpi_signature(body, timestamp, signature, secret):
+    expected = hmac.new(secret.encode(), body + timestamp.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+# Ticket ID of a webhook item, None unless it is a positive integer (or a string holding one)
+def _webhook_ticket_id(item):
+    value = item.get("id")
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        ticket_id = int(value)
+    except ValueError:
+        return None
+    return ticket_id if 0 < ticket_id <= MAX_TICKET_ID else None
+
+def make_webhook_app(pipeline, secret=None):
+    tenant = current_tenant()
+    secret = tenant.WEBHOOK_SECRET if secret is None else secret
+
+    async def handle_webhook(request):
+        body = await request.read()
+        timestamp = request.headers.get("X-GLPI-timestamp", "")
+        signature = request.headers.get("X-GLPI-signature", "")
+        if not verify_glpi_signature(body, timestamp, signature, secret):
+            logger.warning("Rejected webhook with an invalid signature")
+            return web.Response(status=401)
+        try:
+            if abs(time.time() - int(timestamp)) > WEBHOOK_MAX_SKEW:
+                logger.warning("Rejected webhook with an expired timestamp")
+                return web.Response(status=401)
+            payload = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(payload, dict):
+            return web.Response(status=400)
+        item = payload.get("item") if isinstance(payload.get("item"), dict) else payload
+        event = payload.get("event", "new")
+        if "id" in item and _webhook_ticket_id(item) is None:
+            logger.warning(f"Rejected webhook with an invalid ticket ID: {item['id']!r}")
+            return web.Response(status=400)
+        if event in ("new", "add") and "id" in item:
+            await pipeline.publish([item])
+        elif event == "update" and "id" in item and pipeline.tenant.TRACK_CHANGES:
+            ticket_id = _webhook_ticket_id(item)
+            if ticket_id not in pipeline.seen and ticket_id <= pipeline.poll_watermark:
+                # Polling already went past this ticket, so it is not new: only record its fields
+                pipeline.mark_seen([item])
+            else:
+                await pipeline.publish([item])
+        return web.json_response({"status": "ok"})
+
+    app = web.Application()
+    app.router.add_post(tenant.WEBHOOK_PATH, handle_webhook)
+    return app
+
+async def start_webhook_server(pipeline):
+    tenant = current_tenant()
+    runner = web.AppRunner(make_webhook_app(pipeline))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, tenant.WEBHOOK_PORT)
+    try:
+        await site.start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    logger.info(f"Listening for GLPI webhooks on {WEBHOOK_HOST}:{tenant.WEBHOOK_PORT}{tenant.WEBHOOK_PATH}")
+    return runner
+
+# Monitor one tenant, restarting it with a growing delay if it fails so the other tenants sharing
+# the event loop keep running
+async def run_tenant(tenant):
+    _current_tenant.set(tenant)
+    failures = 0
+    while True:
+        try:
+            await _monitor_glpi_tickets()
+            return
+        except Exception as e:
+            failures += 1
+            stats["errors"] += 1
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+            logger.error(f"Tenant monitor failed: {e}, restarting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+# Run one monitor per tenant in this event loop, sharing the HTTP pools and Matrix rate limits
+async def monitor_glpi_tickets(tenants=None):
+    if tenants is None:
+        tenants = load_tenants(TENANTS_FILE) if TENANTS_FILE else [DEFAULT_TENANT]
+    try:
+        if len(tenants) == 1 and tenants[0] is DEFAULT_TENANT:
+            await _monitor_glpi_tickets()
+        else:
+            logger.info(f"Monitoring {len(tenants)} tenants")
+            await asyncio.gather(*(run_tenant(tenant) for tenant in tenants))
+    finally:
+        await close_http_sessions()
+
+async def _monitor_glpi_tickets():
+    tenant = current_tenant()
+    glpi_session = GlpiSessionManager()
+    breaker = glpi_breaker()
+    while not (breaker.allow() and await glpi_session.refresh()):
+        delay = breaker.retry_delay()
+        logger.error(f"Unable to initialize GLPI session, retrying in {delay:.0f}s")
+        await asyncio.sleep(delay)
+    glpi_session.start()
+    store = StateStore(STATE_FILE) if STATE_FILE else None
+    journal = NotificationJournal(tenant.journal_path) if tenant.journal_path else None
+    queue = asyncio.Queue(maxsize=MATRIX_QUEUE_SIZE)
+    sender = asyncio.create_task(run_matrix_sender(queue, journal))
+    pipeline = TicketPipeline(queue, store, journal)
+    webhook_runner = None
+    try:
+        if journal:
+            replayed = await replay_journal(queue, journal)
+            if replayed:
+                logger.info(f"Replaying {replayed} notifications left from the previous run")
+        if tenant.WEBHOOK_PORT:
+            if tenant.WEBHOOK_SECRET:
+                try:
+                    webhook_runner = await start_webhook_server(pipeline)
+                except OSError as e:
+                    logger.error(f"Cannot listen for webhooks on port {tenant.WEBHOOK_PORT}: {e}, only polling will run")
+            else:
+                logger.error("WEBHOOK_SECRET is required to accept GLPI webhooks, only polling will run")
+        await _poll_glpi_tickets(glpi_session, pipeline, webhook_runner is not None)
+    finally:
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        try:
+            await asyncio.wait_for(queue.join(), MATRIX_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            if journal:
+                logger.warning("Undelivered notifications kept in the journal for the next start")
+            else:
+                logger.warning(f"Dropping {queue.qsize()} notifications not sent before shutdown")
+        sender.cancel()
+        try:
+            await sender
+        except asyncio.CancelledError:
+            pass
+        await glpi_session.close()
+        if store:
+            store.close()
+        if journal:
+            journal.close()
+
+async def _poll_glpi_tickets(glpi_session, pipeline, webhooks=False):
+    tenant = current_tenant()
+    seen = pipeline.seen
+    if pipeline.resumed:
+        logger.info(f"Resuming from ticket ID {seen.watermark}")
+    # Apart from "list", modes start from the tickets that already exist instead of announcing them
+    seeded = pipeline.resumed or tenant.GLPI_FETCH_MODE == "list"
+    if tenant.GLPI_FETCH_MODE == "changes":
+        seeded = pipeline.cursor is not None
+    if webhooks:
+        # Webhooks deliver new tickets, polling is only a slow reconciliation pass
+        scheduler = PollScheduler(WEBHOOK_POLL_INTERVAL, WEBHOOK_POLL_INTERVAL, windows=[])
+    else:
+        scheduler = PollScheduler()
+    breaker = glpi_breaker()
 
     while True:
         try:
-            tickets = await fetch_glpi_tickets(session_token)
+            if not breaker.allow():
+                await asyncio.sleep(breaker.retry_delay())
+                continue
+            session_token = await glpi_session.get_token()
+            new_count = 0
+            if tenant.GLPI_FETCH_MODE == "changes" and not seeded:
+                # Start from the latest change instead of announcing the whole table
+                tickets = await search_changed_glpi_tickets(session_token, order="DESC", limit=1)
+                if tickets:
+                    pipeline.seed(tickets)
+                    pipeline.move_cursor((tickets[0]["date_mod"], tickets[0]["id"]))
+                    seeded = True
+                    logger.info(f"Watching for changes after {pipeline.cursor[0]}")
+                    tickets = []
+            elif tenant.GLPI_FETCH_MODE in ("search", "newest") and not seeded:
+                # Start from the newest existing ticket instead of announcing the whole table
+                if tenant.GLPI_FETCH_MODE == "search":
+                    tickets = await search_glpi_tickets(session_token, order="DESC", limit=1)
+                else:
+                    tickets = await fetch_newest_glpi_tickets(session_token, 1)
+                if tickets:
+                    pipeline.seed(tickets[:1])
+                    seeded = True
+                    logger.info(f"Watching for tickets above ID {seen.watermark}")
+                    tickets = []
+            elif tenant.GLPI_FETCH_MODE == "changes":
+                tickets = await fetch_changed_glpi_tickets(session_token, pipeline.cursor)
+            elif tenant.GLPI_FETCH_MODE == "search":
+                tickets = await search_glpi_tickets(session_token, after_id=pipeline.poll_watermark)
+            elif tenant.GLPI_FETCH_MODE == "newest":
+                tickets = await fetch_new_glpi_tickets_window(session_token, seen)
+            elif tenant.GLPI_FETCH_MODE == "paged":
+                tickets = await fetch_all_glpi_tickets(session_token)
+            else:
+                tickets = await fetch_glpi_tickets(session_token)
+            stats["polls"] += 1
             if tickets is None:
                 # Session probably expired, try to re-authenticate
                 logger.info("Re-initializing GLPI session.")
-                kill_glpi_session(session_token)
-                session_token = init_glpi_session()
-                if not session_token:
-                    logger.error("Failed to re-initialize session. Stopping.")
-                    break
+                if not await glpi_session.refresh(session_token):
+                    delay = breaker.retry_delay()
+                    logger.error(f"Failed to re-initialize session, retrying in {delay:.0f}s")
+                    await asyncio.sleep(delay)
                 continue
             if tickets:
-                # Normalize ticket IDs as string
-                current_tickets = set(str(ticket['id']) for ticket in tickets if 'id' in ticket)
-                new_tickets = current_tickets - previous_tickets
-                for ticket_id in new_tickets:
-                    ticket_info = next((t for t in tickets if str(t.get('id')) == ticket_id), None)
-                    if ticket_info:
-                        message = f"{MESSAGE} {ticket_info.get('name', 'No name')} (ID: {ticket_id})"
-                        await send_matrix_message(message)
-                previous_tickets = current_tickets
-            error_count = 0  # Reset error count on success
-            await asyncio.sleep(60)
+                if not seeded:
+                    # A full scan covers the whole table, only remember it on the first pass
+                    logger.info(f"Watching {pipeline.seed(tickets)} existing tickets")
+                    seeded = True
+                elif tenant.GLPI_FETCH_MODE == "changes":
+                    new_count = await pipeline.publish_changes(tickets)
+                    stats["notifications"] += new_count
+                else:
+                    new_count = await pipeline.publish(tickets)
+                    stats["notifications"] += new_count
+                pipeline.move_poll_watermark(tickets)
+            # After the tickets, so a ticket is announced before its first follow-up
+            for itemtype in filter(None, (name.strip() for name in tenant.SUBITEM_TYPES.split(","))):
+                item_count = await poll_glpi_subitems(session_token, pipeline, itemtype)
+                stats["notifications"] += item_count
+                new_count += item_count
+            if tickets and tenant.GLPI_FETCH_MODE == "search" and len(tickets) >= GLPI_SEARCH_RANGE:
+                # More new tickets are waiting, fetch them without sleeping
+                continue
+            if breaker.failures:
+                # The poll failed, wait for the backoff rather than the regular interval
+                await asyncio.sleep(breaker.retry_delay())
+            else:
+                await asyncio.sleep(scheduler.next_interval(new_count))
         except asyncio.CancelledError:
             logger.info("Ticket monitoring stopped.")
             break
         except Exception as e:
-            logger.error(f"Error in monitoring loop: {e}")
-            error_count += 1
-            if error_count >= max_errors:
-                logger.error("Too many consecutive errors, stopping monitor.")
-                break
-            await asyncio.sleep(20)  # Wait longer after an error
-    kill_glpi_session(session_token)
+            stats["errors"] += 1
+            breaker.record_failure()
+            delay = breaker.retry_delay()
+            logger.error(f"Error in monitoring loop: {e}, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
 
 def handle_exit(signum, frame):
     logger.info("Received exit signal, shutting down...")
     sys.exit(0)
 
+# Split tenants round-robin into at most `workers` shards
+def shard_tenants(tenants, workers):
+    shards = [tenants[i::workers] for i in range(workers)]
+    return [shard for shard in shards if shard]
+
+# Worker process entry point: monitor a shard of tenants and report stats over the pipe
+def run_worker(worker_id, tenant_entries, conn):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops workers with SIGTERM
+    signal.signal(signal.SIGTERM, handle_exit)
+    tenants = [Tenant(name, settings) for name, settings in tenant_entries]
+    asyncio.run(_run_worker(worker_id, tenants, conn))
+
+async def _run_worker(worker_id, tenants, conn):
+    async def report():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            conn.send({"worker": worker_id, "pid": os.getpid(), "tenants": len(tenants), **stats})
+
+    reporter = asyncio.create_task(report())
+    try:
+        await monitor_glpi_tickets(tenants)
+    finally:
+        reporter.cancel()
+        conn.send({"worker": worker_id, "pid": os.getpid(), "tenants": len(tenants), **stats})
+        conn.close()
+
+# A crashed worker is restarted right away so its tenants are not left unmonitored, only a
+# shard that keeps crashing soon after starting waits, with a growing delay
+def worker_restart_delay(crashes):
+    if crashes <= 1:
+        return 0
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (crashes - 2))
+
+# Run tenant shards in worker processes, restarting any worker that dies
+async def supervise_tenants(tenants, workers):
+    context = multiprocessing.get_context("spawn")
+    shards = shard_tenants(tenants, workers)
+    processes = {}
+    started_at = {}
+    crashes = collections.Counter()
+    restart_at = {}
+    worker_stats = {}
+    # Counters of workers that were replaced, so totals do not drop back after a restart
+    retired_stats = collections.Counter()
+
+    def start(worker_id):
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        entries = [(tenant.name, tenant.settings) for tenant in shards[worker_id]]
+        process = context.Process(
+            target=run_worker, args=(worker_id, entries, child_conn), name=f"glpi-worker-{worker_id}", daemon=True
+        )
+        process.start()
+        child_conn.close()
+        processes[worker_id] = (process, parent_conn)
+        started_at[worker_id] = time.monotonic()
+        logger.info(f"Started worker {worker_id} (pid {process.pid}) for {len(entries)} tenants")
+
+    logger.info(f"Spreading {len(tenants)} tenants over {len(shards)} workers")
+    for worker_id in range(len(shards)):
+        start(worker_id)
+    last_report = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for worker_id, (process, conn) in list(processes.items()):
+                try:
+                    while conn.poll():
+                        worker_stats[worker_id] = conn.recv()
+                except (EOFError, OSError):
+                    pass
+                if process.is_alive() or worker_id in restart_at:
+                    continue
+                conn.close()
+                report = worker_stats.pop(worker_id, {})
+                retired_stats.update({k: v for k, v in report.items() if k not in ("worker", "pid", "tenants")})
+                if now - started_at[worker_id] < 60:
+                    crashes[worker_id] += 1
+                else:
+                    crashes[worker_id] = 1
+                delay = worker_restart_delay(crashes[worker_id])
+                logger.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting in {delay:.0f}s")
+                restart_at[worker_id] = now + delay
+            for worker_id, when in list(restart_at.items()):
+                if now >= when:
+                    del restart_at[worker_id]
+                    start(worker_id)
+            if now - last_report >= STATS_INTERVAL and worker_stats:
+                last_report = now
+                totals = collections.Counter(retired_stats)
+                for report in worker_stats.values():
+                    totals.update({k: v for k, v in report.items() if k not in ("worker", "pid")})
+                alive = sum(1 for process, _ in processes.values() if process.is_alive())
+                summary = ", ".join(f"{key}={value}" for key, value in sorted(totals.items()))
+                logger.info(f"Workers alive: {alive}/{len(shards)}, {summary}")
+    finally:
+        for process, _ in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in processes.values():
+            process.join(MATRIX_DRAIN_TIMEOUT + 5)
+
 async def main():
     check_env()
     # Handle signals for graceful shutdown
     signal.signal(signal.SIGINT, handle_exit)
     signal.signal(signal.SIGTERM, handle_exit)
     try:
-        await monitor_glpi_tickets()
+        if TENANTS_FILE and WORKERS > 1:
+            await supervise_tenants(load_tenants(TENANTS_FILE), WORKERS)
+        else:
+            await monitor_glpi_tickets()
     except KeyboardInterrupt:
         logger.info("Script stopped manually.")
 
@@ -1,23 +1,40 @@
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock
 import asyncio
+import json
 import script
 
 
-@patch('script.requests.get')
-def test_init_glpi_session_success(mock_get, monkeypatch):
+@pytest.fixture(autouse=True)
+def reset_http_sessions():
+    script._http_sessions.clear()
+    script._matrix_buckets.clear()
+    script._circuit_breakers.clear()
+    yield
+    script._http_sessions.clear()
+    script._matrix_buckets.clear()
+    script._circuit_breakers.clear()
+
+
+@patch('script.aiohttp.ClientSession')
+def test_init_glpi_session_success(mock_client_session, monkeypatch):
     monkeypatch.setattr(script, 'GLPI_API_URL', 'http://glpi')
     monkeypatch.setattr(script, 'GLPI_APP_TOKEN', 'token')
     monkeypatch.setattr(script, 'GLPI_USERNAME', 'user')
     monkeypatch.setattr(script, 'GLPI_PASSWORD', 'pass')
 
-    mock_resp = MagicMock()
-    mock_resp.status_code = 200
-    mock_resp.json.return_value = {'session_token': 'abc123'}
-    mock_get.return_value = mock_resp
+    session_instance = MagicMock(closed=False)
+    response_mock = AsyncMock()
+    response_mock.__aenter__.return_value = response_mock
+    response_mock.__aexit__.return_value = False
+    response_mock.status = 200
+    response_mock.json = AsyncMock(return_value={'session_token': 'abc123'})
+    session_instance.get = MagicMock(return_value=response_mock)
+    mock_client_session.return_value = session_instance
 
-    token = script.init_glpi_session()
+    token = asyncio.run(script.init_glpi_session())
     assert token == 'abc123'
+    assert session_instance.get.call_args.kwargs['headers']['Authorization'] == 'Basic dXNlcjpwYXNz'
 
 
 @patch('script.aiohttp.ClientSession')
@@ -26,13 +43,13 @@ def test_send_matrix_message_success(mock_client_session, monkeypatch):
     monkeypatch.setattr(script, 'MATRIX_TOKEN', 'token')
     monkeypatch.setattr(script, 'ROOM_ID', 'room')
 
-    session_instance = MagicMock()
+    session_instance = MagicMock(closed=False)
     response_mock = AsyncMock()
     response_mock.__aenter__.return_value = response_mock
     response_mock.__aexit__.return_value = False
     response_mock.status = 200
     session_instance.put = MagicMock(return_value=response_mock)
-    mock_client_session.return_value.__aenter__.return_value = session_instance
+    mock_client_session.return_value = session_instance
 
     result = asyncio.run(script.send_matrix_message('hi'))
     assert result is True
@@ -44,14 +61,1094 @@ def test_send_matrix_message_failure(mock_client_session, monkeypatch):
     monkeypatch.setattr(script, 'MATRIX_TOKEN', 'token')
     monkeypatch.setattr(script, 'ROOM_ID', 'room')
 
-    session_instance = MagicMock()
+    session_instance = MagicMock(closed=False)
     response_mock = AsyncMock()
     response_mock.__aenter__.return_value = response_mock
     response_mock.__aexit__.return_value = False
     response_mock.status = 400
     response_mock.text = AsyncMock(return_value='error')
     session_instance.put = MagicMock(return_value=response_mock)
-    mock_client_session.return_value.__aenter__.return_value = session_instance
+    mock_client_session.return_value = session_instance
+
+    result = asyncio.run(script.send_matrix_message('hi'))
+    assert result is None
+    response_mock.status = 502
+    assert asyncio.run(script.send_matrix_message('hi')) is False
+    # M_UNKNOWN_TOKEN is not about this message, it is retried under the circuit breaker
+    response_mock.status = 401
+    assert asyncio.run(script.send_matrix_message('hi')) is False
+    assert script.matrix_breaker().failures == 1
+
+
+@patch('script.aiohttp.ClientSession')
+def test_search_glpi_tickets_after_id(mock_client_session, monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_API_URL', 'http://glpi')
+    monkeypatch.setattr(script, 'GLPI_APP_TOKEN', 'token')
+
+    session_instance = MagicMock(closed=False)
+    response_mock = AsyncMock()
+    response_mock.__aenter__.return_value = response_mock
+    response_mock.__aexit__.return_value = False
+    response_mock.status = 200
+    response_mock.json = AsyncMock(return_value={
+        'totalcount': 2,
+        'data': [{'2': 11, '1': 'Printer'}, {'2': '12', '1': 'VPN'}],
+    })
+    session_instance.get = MagicMock(return_value=response_mock)
+    mock_client_session.return_value = session_instance
+
+    tickets = asyncio.run(script.search_glpi_tickets('abc', after_id=10))
+    assert tickets == [{'id': 11, 'name': 'Printer'}, {'id': 12, 'name': 'VPN'}]
+    params = session_instance.get.call_args.kwargs['params']
+    assert params['criteria[0][searchtype]'] == 'morethan'
+    assert params['criteria[0][value]'] == '10'
+
+
+def test_parse_content_range():
+    assert script._parse_content_range('0-49/1234') == (0, 49, 1234)
+    assert script._parse_content_range(None) is None
+    assert script._parse_content_range('garbage') is None
+
+
+@patch('script.aiohttp.ClientSession')
+def test_fetch_all_glpi_tickets_follows_content_range(mock_client_session, monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_API_URL', 'http://glpi')
+    monkeypatch.setattr(script, 'GLPI_APP_TOKEN', 'token')
+    monkeypatch.setattr(script, 'GLPI_PAGE_SIZE', 2)
+
+    def make_response(params):
+        start, end = (int(x) for x in params['range'].split('-'))
+        end = min(end, 4)
+        response_mock = AsyncMock()
+        response_mock.__aenter__.return_value = response_mock
+        response_mock.__aexit__.return_value = False
+        response_mock.status = 206
+        response_mock.headers = {'Content-Range': f'{start}-{end}/5'}
+        response_mock.json = AsyncMock(return_value=[{'id': i} for i in range(start, end + 1)])
+        return response_mock
+
+    session_instance = MagicMock(closed=False)
+    session_instance.get = MagicMock(side_effect=lambda url, headers, params: make_response(params))
+    mock_client_session.return_value = session_instance
+
+    tickets = asyncio.run(script.fetch_all_glpi_tickets('abc'))
+    assert sorted(t['id'] for t in tickets) == [0, 1, 2, 3, 4]
+    ranges = [c.kwargs['params']['range'] for c in session_instance.get.call_args_list]
+    assert ranges == ['0-1', '2-3', '4-4']
+
+
+def test_fetch_new_glpi_tickets_window_grows_until_seen_ticket(monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_WINDOW_SIZE', 2)
+    monkeypatch.setattr(script, 'GLPI_WINDOW_MAX', 16)
+    limits = []
+
+    async def fake_newest(session_token, limit):
+        limits.append(limit)
+        return [{'id': i} for i in range(20, 20 - limit, -1)]
+
+    monkeypatch.setattr(script, 'fetch_newest_glpi_tickets', fake_newest)
+    seen = script.SeenTickets()
+    for ticket_id in range(1, 16):
+        seen.add(ticket_id)
+    tickets = asyncio.run(script.fetch_new_glpi_tickets_window('abc', seen))
+    assert limits == [2, 4, 8]
+    assert [t['id'] for t in tickets] == [16, 17, 18, 19, 20]
+
+
+def test_http_sessions_are_shared_and_closed():
+    async def run():
+        first = script.get_http_session('matrix')
+        assert script.get_http_session('matrix') is first
+        assert script.get_http_session('glpi') is not first
+        await script.close_http_sessions()
+        assert first.closed
+        assert script._http_sessions == {}
+
+    asyncio.run(run())
+
+
+def test_glpi_session_manager_refreshes_aged_token(monkeypatch):
+    tokens = iter(['first', 'second'])
+    killed = []
+
+    async def fake_init():
+        return next(tokens)
+
+    async def fake_kill(token):
+        killed.append(token)
+
+    monkeypatch.setattr(script, 'init_glpi_session', fake_init)
+    monkeypatch.setattr(script, 'kill_glpi_session', fake_kill)
+
+    async def run():
+        manager = script.GlpiSessionManager(refresh_after=60, keepalive_interval=30)
+        assert await manager.get_token() == 'first'
+        assert await manager.get_token() == 'first'
+        manager.issued_at -= 61
+        assert await manager.get_token() == 'second'
+        assert killed == ['first']
+        await manager.close()
+        assert killed == ['first', 'second']
+
+    asyncio.run(run())
+
+
+def test_glpi_session_manager_single_flight_refresh(monkeypatch):
+    calls = []
+
+    async def fake_init():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return f'token{len(calls)}'
+
+    async def fake_kill(token):
+        pass
+
+    monkeypatch.setattr(script, 'init_glpi_session', fake_init)
+    monkeypatch.setattr(script, 'kill_glpi_session', fake_kill)
+
+    async def run():
+        manager = script.GlpiSessionManager()
+        await manager.refresh()
+        results = await asyncio.gather(*(manager.refresh('token1') for _ in range(5)))
+        assert results == ['token2'] * 5
+        # A caller holding the token that was already replaced does not log in again
+        assert await manager.refresh('token1') == 'token2'
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_glpi_session_manager_backs_off_after_failed_refresh(monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_API_URL', 'http://glpi')
+    monkeypatch.setattr(script, 'BACKOFF_BASE', 10)
+    real_sleep = asyncio.sleep
+    delays = []
+    logins = []
+
+    async def fake_init():
+        logins.append(1)
+        script.glpi_breaker().record_failure()
+        return None
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        if len(delays) >= 4:
+            raise asyncio.CancelledError
+        await real_sleep(0)
+
+    monkeypatch.setattr(script, 'init_glpi_session', fake_init)
+    monkeypatch.setattr(script.asyncio, 'sleep', fake_sleep)
+
+    async def run():
+        manager = script.GlpiSessionManager(refresh_after=60)
+        with pytest.raises(asyncio.CancelledError):
+            await manager._run()
+
+    asyncio.run(run())
+    # Every failed login is followed by the breaker's backoff, not the one second floor
+    assert len(logins) == 2
+    assert delays[1] >= 5 and delays[3] >= 5
+
+
+def test_diff_new_tickets_indexes_by_int_id():
+    tickets = [{'id': '3', 'name': 'a'}, {'id': 4, 'name': 'b'}, {'name': 'no id'}, {'id': 4, 'name': 'dup'}]
+    index, new_tickets = script.diff_new_tickets(tickets, {3})
+    assert set(index) == {3, 4}
+    assert index[3]['name'] == 'a'
+    assert [t['name'] for t in new_tickets] == ['b']
+
+
+def test_seen_tickets_watermark_and_late_ids():
+    seen = script.SeenTickets(window=16)
+    for ticket_id in (100, 102, 103):
+        seen.add(ticket_id)
+    assert seen.watermark == 103
+    assert 102 in seen
+    assert 101 not in seen  # still inside the window, may become visible later
+    assert 104 not in seen
+    assert 80 in seen  # below the window, treated as seen
+    seen.add(101)
+    assert 101 in seen
+    seen.add(200)
+    assert 103 in seen
+    assert 190 not in seen
+
+
+def test_seeded_newest_window_has_nothing_new(monkeypatch):
+    async def fake_newest(session_token, limit):
+        return [{'id': i} for i in range(500, 500 - limit, -1)]
+
+    monkeypatch.setattr(script, 'fetch_newest_glpi_tickets', fake_newest)
+
+    async def run():
+        pipeline = script.TicketPipeline(asyncio.Queue())
+        pipeline.seed(await script.fetch_newest_glpi_tickets('abc', 1))
+        return await script.fetch_new_glpi_tickets_window('abc', pipeline.seen)
+
+    assert asyncio.run(run()) == []
+    seen = script.SeenTickets(window=64)
+    seen.add(100)
+    seen.advance_to(90)
+    assert 80 in seen and 99 not in seen
+
+
+def test_state_store_round_trips_seen_tickets(tmp_path):
+    path = str(tmp_path / 'state.db')
+    store = script.StateStore(path)
+    assert store.load_seen() is None
+    seen = script.SeenTickets(window=16)
+    for ticket_id in (40, 42):
+        seen.add(ticket_id)
+    store.save_seen(seen)
+    store.close()
+
+    loaded = script.StateStore(path).load_seen()
+    assert loaded.watermark == 42
+    assert loaded.window == 16
+    assert 40 in loaded and 42 in loaded
+    assert 41 not in loaded
+
+
+@patch('script.aiohttp.ClientSession')
+def test_send_matrix_message_retries_after_rate_limit(mock_client_session, monkeypatch):
+    monkeypatch.setattr(script, 'MATRIX_HOMESERVER', 'http://matrix')
+    monkeypatch.setattr(script, 'MATRIX_TOKEN', 'token')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+
+    limited = AsyncMock()
+    limited.__aenter__.return_value = limited
+    limited.__aexit__.return_value = False
+    limited.status = 429
+    limited.json = AsyncMock(return_value={'errcode': 'M_LIMIT_EXCEEDED', 'retry_after_ms': 20})
+    accepted = AsyncMock()
+    accepted.__aenter__.return_value = accepted
+    accepted.__aexit__.return_value = False
+    accepted.status = 200
+    session_instance = MagicMock(closed=False)
+    session_instance.put = MagicMock(side_effect=[limited, accepted])
+    mock_client_session.return_value = session_instance
 
     result = asyncio.run(script.send_matrix_message('hi'))
-    assert result is False
+    assert result is True
+    assert session_instance.put.call_count == 2
+    bucket = script._matrix_buckets['http://matrix']
+    assert bucket.rate < script.MATRIX_RATE
+
+
+def test_token_bucket_paces_after_burst():
+    async def run():
+        bucket = script.TokenBucket(rate=50, burst=2)
+        start = script.time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return script.time.monotonic() - start
+
+    elapsed = asyncio.run(run())
+    assert 0.03 <= elapsed < 0.5
+
+
+def test_token_bucket_rate_recovers_after_quiet_period():
+    async def run():
+        bucket = script.TokenBucket(rate=100, burst=5, recovery=60)
+        bucket.pause(0)
+        bucket.pause(0)
+        lowered = bucket.rate
+        await bucket.acquire()
+        assert bucket.rate == lowered
+        for _ in range(3):
+            bucket.limited_at -= 60
+            await bucket.acquire()
+        return lowered, bucket.rate
+
+    lowered, recovered = asyncio.run(run())
+    assert lowered < 100
+    assert recovered == 100
+
+
+def test_matrix_txn_id_is_deterministic_per_event():
+    assert script.matrix_txn_id(42) == script.matrix_txn_id(42)
+    assert script.matrix_txn_id(42) != script.matrix_txn_id(43)
+    assert script.matrix_txn_id(42) != script.matrix_txn_id(42, kind='updated')
+    assert script.matrix_txn_id() != script.matrix_txn_id()
+    assert script.MATRIX_TXN_NONCE in script.matrix_txn_id(42)
+
+
+def test_deliver_matrix_messages_orders_each_room(monkeypatch):
+    monkeypatch.setattr(script, 'MATRIX_SEND_CONCURRENCY', 2)
+    monkeypatch.setattr(script, 'MATRIX_ROOM_ORDERING', True)
+    sent = []
+    in_flight = []
+
+    async def fake_send(message, txn_id=None, room_id=None):
+        in_flight.append(room_id)
+        assert len(in_flight) <= 2
+        await asyncio.sleep(0.01 if message.endswith('1') else 0)
+        in_flight.remove(room_id)
+        sent.append((room_id, message))
+        return message != 'b1'
+
+    monkeypatch.setattr(script, 'send_matrix_message', fake_send)
+    notifications = [('a', 'a1', 't1'), ('b', 'b1', 't2'), ('a', 'a2', 't3'), ('b', 'b2', 't4')]
+    results = asyncio.run(script.deliver_matrix_messages(notifications))
+    assert results == [True, False, True, False]
+    assert [m for r, m in sent if r == 'a'] == ['a1', 'a2']
+    # b2 is held back until b1 went through
+    assert [m for r, m in sent if r == 'b'] == ['b1']
+
+
+def test_enqueue_notification_policies(monkeypatch):
+    async def run(policy):
+        monkeypatch.setattr(script, 'MATRIX_QUEUE_POLICY', policy)
+        queue = asyncio.Queue(maxsize=2)
+        for i in range(3):
+            await script.enqueue_notification(queue, ('room', f'ticket {i}', f't{i}'))
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    assert [n[1] for n in asyncio.run(run('drop_oldest'))] == ['ticket 1', 'ticket 2']
+    digest = asyncio.run(run('digest'))
+    assert len(digest) == 1
+    assert digest[0][1] == '3 new notifications\n- ticket 0\n- ticket 1\n- ticket 2'
+
+
+def test_run_matrix_sender_drains_queue(monkeypatch):
+    monkeypatch.setattr(script, 'DIGEST_WINDOW', 0)
+    batches = []
+
+    async def fake_deliver(batch):
+        batches.append([n[1] for n in batch])
+        return [True] * len(batch)
+
+    monkeypatch.setattr(script, 'deliver_matrix_messages', fake_deliver)
+
+    async def run():
+        queue = asyncio.Queue()
+        for i in range(3):
+            queue.put_nowait(('room', f'ticket {i}', f't{i}'))
+        sender = asyncio.create_task(script.run_matrix_sender(queue))
+        await queue.join()
+        sender.cancel()
+
+    asyncio.run(run())
+    assert batches == [['ticket 0', 'ticket 1', 'ticket 2']]
+
+
+def test_digests_are_told_apart_from_tenant_names(monkeypatch):
+    async def txn_ids():
+        script._current_tenant.set(script.Tenant('eu-digest-1'))
+        return script.matrix_txn_id(42), script.matrix_txn_id(kind='digest')
+
+    ticket_txn, digest_txn = asyncio.run(txn_ids())
+    assert not script._is_digest(('room', 'message', ticket_txn))
+    assert script._is_digest(('room', 'digest', digest_txn))
+
+
+def test_notification_journal_replays_unacked(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = script.NotificationJournal(path, compact_every=2)
+    for i in range(3):
+        journal.append(('room', f'ticket {i}', f't{i}'))
+    journal.ack('t0')
+    journal.flush()
+    assert [n[2] for n in journal.pending()] == ['t1', 't2']
+    journal.ack('t1')
+    journal.flush()  # second ack triggers compaction
+    journal.close()
+    with open(path) as journal_file:
+        assert journal_file.read().count('\n') == 1
+    assert list(script.NotificationJournal(path).pending()) == [('room', 'ticket 2', 't2')]
+
+
+def test_replay_journal_does_not_replay_its_own_digests(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'MATRIX_QUEUE_POLICY', 'digest')
+    journal = script.NotificationJournal(str(tmp_path / 'journal'))
+    for i in range(5):
+        journal.append(('room', f'ticket {i}', f't{i}'))
+    journal.flush()
+    enqueued = []
+    enqueue = script.enqueue_notification
+
+    async def counting_enqueue(queue, notification, journal=None):
+        enqueued.append(notification[2])
+        await enqueue(queue, notification, journal)
+
+    monkeypatch.setattr(script, 'enqueue_notification', counting_enqueue)
+    assert asyncio.run(script.replay_journal(asyncio.Queue(maxsize=2), journal)) == 5
+    # Digests written to the journal while collapsing the full queue are not read back
+    assert enqueued == ['t0', 't1', 't2', 't3', 't4']
+
+
+def test_run_matrix_sender_retries_failed_with_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'DIGEST_WINDOW', 0)
+    monkeypatch.setattr(script, 'BACKOFF_BASE', 0)
+    attempts = []
+
+    async def fake_deliver(batch):
+        attempts.append([n[2] for n in batch])
+        return [len(attempts) > 1] * len(batch)
+
+    monkeypatch.setattr(script, 'deliver_matrix_messages', fake_deliver)
+    journal = script.NotificationJournal(str(tmp_path / 'journal'))
+
+    async def run():
+        queue = asyncio.Queue()
+        journal.append(('room', 'ticket 1', 't1'))
+        queue.put_nowait(('room', 'ticket 1', 't1'))
+        sender = asyncio.create_task(script.run_matrix_sender(queue, journal))
+        await queue.join()
+        sender.cancel()
+
+    asyncio.run(run())
+    assert attempts == [['t1'], ['t1']]
+    assert list(journal.pending()) == []
+
+
+def test_run_matrix_sender_drops_rejected_with_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'DIGEST_WINDOW', 0)
+    attempts = []
+
+    async def fake_deliver(batch):
+        attempts.append([n[2] for n in batch])
+        return [None] * len(batch)
+
+    monkeypatch.setattr(script, 'deliver_matrix_messages', fake_deliver)
+    journal = script.NotificationJournal(str(tmp_path / 'journal'))
+
+    async def run():
+        queue = asyncio.Queue()
+        journal.append(('!unknown', 'ticket 1', 't1'))
+        queue.put_nowait(('!unknown', 'ticket 1', 't1'))
+        sender = asyncio.create_task(script.run_matrix_sender(queue, journal))
+        await asyncio.wait_for(queue.join(), 1)
+        sender.cancel()
+
+    asyncio.run(run())
+    assert attempts == [['t1']]
+    assert list(journal.pending()) == []
+
+
+def test_run_matrix_sender_coalesces_burst(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'DIGEST_WINDOW', 0)
+    monkeypatch.setattr(script, 'DIGEST_THRESHOLD', 3)
+    monkeypatch.setattr(script, 'DIGEST_MAX_LINES', 2)
+    monkeypatch.setattr(script, 'MESSAGE', 'New ticket:')
+    batches = []
+
+    async def fake_deliver(batch):
+        batches.append(batch)
+        return [True] * len(batch)
+
+    monkeypatch.setattr(script, 'deliver_matrix_messages', fake_deliver)
+    journal = script.NotificationJournal(str(tmp_path / 'journal'))
+
+    async def run():
+        queue = asyncio.Queue()
+        for i in range(4):
+            notification = ('room', f'New ticket: T{i} (ID: {i})', f't{i}')
+            journal.append(notification)
+            queue.put_nowait(notification)
+        queue.put_nowait(('other', 'New ticket: X (ID: 9)', 't9'))
+        sender = asyncio.create_task(script.run_matrix_sender(queue, journal))
+        await queue.join()
+        sender.cancel()
+
+    asyncio.run(run())
+    assert len(batches) == 1
+    digest, other = batches[0]
+    assert digest[0] == 'room'
+    assert digest[1] == 'New ticket: 4 new notifications\n- T0 (ID: 0)\n- T1 (ID: 1)\n- ... and 2 more'
+    assert other[2] == 't9'
+    assert list(journal.pending()) == []
+
+
+def test_poll_scheduler_windows_and_rate():
+    windows = script.parse_poll_windows('mon-fri 08:00-18:00 10-30; * 22:00-06:00 300-900')
+    scheduler = script.PollScheduler(min_interval=15, max_interval=60, windows=windows, jitter=0)
+    monday_noon = script.datetime.datetime(2024, 1, 1, 12, 0)
+    saturday_noon = script.datetime.datetime(2024, 1, 6, 12, 0)
+    sunday_night = script.datetime.datetime(2024, 1, 8, 2, 0)
+    assert scheduler.bounds(monday_noon) == (10, 30)
+    assert scheduler.bounds(saturday_noon) == (15, 60)
+    assert scheduler.bounds(sunday_night) == (300, 900)
+
+    # No arrivals: poll as rarely as the window allows
+    assert scheduler.next_interval(0, saturday_noon) == 60
+    # A burst pushes the interval down to the lower bound
+    scheduler.last_poll -= 60
+    assert scheduler.next_interval(100, saturday_noon) == 15
+
+
+def test_check_env_rejects_bad_poll_windows(monkeypatch):
+    for var in script.REQUIRED_SETTINGS:
+        monkeypatch.setattr(script, var, 'x')
+    monkeypatch.setattr(script, 'POLL_WINDOWS', 'weekdays 08:00-18:00 10-30')
+    with pytest.raises(SystemExit):
+        script.check_env()
+    monkeypatch.setattr(script, 'POLL_WINDOWS', 'mon-fri 08:00-18:00 10-30')
+    script.check_env()
+
+
+def test_circuit_breaker_opens_and_recovers(monkeypatch):
+    breaker = script.CircuitBreaker('glpi', threshold=2, base_delay=10, max_delay=10)
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert 0 < breaker.retry_delay() <= 15
+
+    breaker.opened_until = script.time.monotonic() - 1
+    assert breaker.allow()  # single half-open probe
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    breaker.opened_until = script.time.monotonic() - 1
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+    # A 4xx answer to the probe still proves the upstream is reachable
+    breaker.record_failure()
+    breaker.opened_until = script.time.monotonic() - 1
+    assert breaker.allow()
+    script.record_upstream_status(breaker, 403)
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_monitor_retries_failed_first_login(monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_API_URL', 'http://glpi')
+    logins = []
+    delays = []
+
+    async def fake_refresh(self, stale_token=None):
+        logins.append(1)
+        if len(logins) > 2:
+            raise RuntimeError('stop')
+        return None
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(script.GlpiSessionManager, 'refresh', fake_refresh)
+    monkeypatch.setattr(script.asyncio, 'sleep', fake_sleep)
+    with pytest.raises(RuntimeError):
+        asyncio.run(script._monitor_glpi_tickets())
+    assert len(logins) == 3 and len(delays) == 2
+
+
+def test_send_matrix_message_refused_while_circuit_open(monkeypatch):
+    monkeypatch.setattr(script, 'MATRIX_HOMESERVER', 'http://matrix')
+    breaker = script.matrix_breaker()
+    assert breaker.name == 'Matrix http://matrix'
+    breaker.state = 'open'
+    breaker.opened_until = script.time.monotonic() + 60
+    with patch('script.get_http_session') as get_http_session:
+        assert asyncio.run(script.send_matrix_message('hi')) is False
+        get_http_session.assert_not_called()
+
+
+def test_ticket_pipeline_publishes_each_ticket_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+
+    async def run():
+        queue = asyncio.Queue()
+        store = script.StateStore(str(tmp_path / 'state.db'))
+        pipeline = script.TicketPipeline(queue, store)
+        assert pipeline.mark_seen([{'id': 1}]) == 1
+        assert await pipeline.publish([{'id': 1, 'name': 'old'}, {'id': 2, 'name': 'VPN'}]) == 1
+        assert await pipeline.publish([{'id': '2', 'name': 'VPN'}]) == 0
+        assert store.load_seen().watermark == 2
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    notifications = asyncio.run(run())
+    assert [n[:2] for n in notifications] == [('room', 'New: VPN (ID: 2)')]
+
+
+def test_routing_table_matches_every_route_field():
+    table = script.RoutingTable([
+        {'room': 'it', 'match': {'entity': [1, 2]}},
+        {'room': 'urgent', 'match': {'priority': [5, 6], 'type': 1}},
+        {'room': 'network', 'match': {'category': ['Network'], 'requester_group': ['NOC']}},
+        {'room': 'it', 'match': {'priority': 6}},
+    ])
+    assert table.rooms_for({'entities_id': 2, 'priority': 6, 'type': 1}) == ['it', 'urgent']
+    assert table.rooms_for({'entities_id': 3, 'priority': 5, 'type': 2}) == []
+    assert table.rooms_for({'entity': 'Root', 'category': 'Network',
+                            'requester_group': 'Users$$##$$NOC'}) == ['network']
+    with pytest.raises(ValueError):
+        script.RoutingTable([{'room': 'x', 'match': {'location': 1}}])
+
+
+def test_ticket_pipeline_routes_to_matching_rooms(tmp_path, monkeypatch):
+    routes_file = tmp_path / 'routes.json'
+    routes_file.write_text(json.dumps({'routes': [
+        {'room': 'hardware', 'match': {'category': [4]}},
+        {'room': 'urgent', 'match': {'priority': [5, 6]}},
+    ]}))
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    monkeypatch.setattr(script, 'ROUTES_FILE', str(routes_file))
+    monkeypatch.setattr(script, '_routing_tables', {})
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        await pipeline.publish([
+            {'id': 1, 'name': 'Printer', 'itilcategories_id': 4, 'priority': 5},
+            {'id': 2, 'name': 'Question', 'itilcategories_id': 9, 'priority': 3},
+        ])
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    notifications = asyncio.run(run())
+    assert [n[0] for n in notifications] == ['hardware', 'urgent', 'room']
+    assert len({n[2] for n in notifications}) == 3
+
+
+def test_ticket_fingerprints_are_sparse_and_saved_by_row(tmp_path):
+    fingerprints = script.TicketFingerprints()
+    assert fingerprints.get(2000000) == 0
+    assert fingerprints.update(2000000, 7) == 0
+    assert fingerprints.update(5, 3) == 0
+    assert fingerprints.update(2000000, 9) == 7
+    assert len(fingerprints) == 2
+    with pytest.raises(ValueError):
+        fingerprints.update(-1, 1)
+    store = script.StateStore(str(tmp_path / 'state.db'))
+    store.save_fingerprints(fingerprints.pop_changes())
+    assert fingerprints.pop_changes() == []
+    fingerprints.update(5, 4)
+    assert fingerprints.pop_changes() == [(5, 4)]
+    loaded = store.load_fingerprints()
+    assert (loaded.get(5), loaded.get(2000000)) == (3, 9)
+    assert script.ticket_fingerprint({'id': 1, 'name': 'x'}) == 0
+    assert script.ticket_fingerprint({'status': 1}) != script.ticket_fingerprint({'status': 2})
+
+
+def test_ticket_pipeline_announces_tracked_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'UPDATE_MESSAGE', 'Updated:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    monkeypatch.setattr(script, 'TRACK_CHANGES', True)
+
+    async def run():
+        queue = asyncio.Queue()
+        store = script.StateStore(str(tmp_path / 'state.db'))
+        pipeline = script.TicketPipeline(queue, store)
+        pipeline.mark_seen([{'id': 1, 'name': 'VPN', 'status': 1, 'priority': 3}])
+        await pipeline.publish([{'id': 1, 'name': 'VPN', 'status': 1, 'priority': 3}])
+        await pipeline.publish([{'id': 1, 'name': 'VPN', 'status': 2, 'priority': 3},
+                                {'id': 2, 'name': 'Mail', 'status': 1, 'priority': 3}])
+        # A restart keeps the fingerprints, an unchanged ticket stays quiet
+        restarted = script.TicketPipeline(queue, store)
+        await restarted.publish([{'id': 1, 'name': 'VPN', 'status': 2, 'priority': 3}])
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    notifications = asyncio.run(run())
+    assert [n[1] for n in notifications] == [
+        'New: Mail (ID: 2)', 'Updated: VPN (ID: 1) - status: Assigned, priority: 3']
+    assert '-updated-' in notifications[1][2]
+
+
+def test_returning_ticket_state_gets_a_new_txn_id(monkeypatch):
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    monkeypatch.setattr(script, 'TRACK_CHANGES', True)
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        pipeline.mark_seen([{'id': 1, 'status': 5, 'date_mod': '2024-05-01 10:00:00'}])
+        await pipeline.publish([{'id': 1, 'status': 2, 'date_mod': '2024-05-01 10:05:00'}])
+        await pipeline.publish([{'id': 1, 'status': 5, 'date_mod': '2024-05-01 10:06:00'}])
+        await pipeline.publish([{'id': 1, 'status': 2, 'date_mod': '2024-05-01 10:07:00'}])
+        await pipeline.publish([{'id': 1, 'status': 5}])
+        return [queue.get_nowait()[2] for _ in range(queue.qsize())]
+
+    txn_ids = asyncio.run(run())
+    assert len(txn_ids) == 4 and len(set(txn_ids)) == 4
+
+
+def test_fetch_changed_glpi_tickets_pages_through_same_second(monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_SEARCH_RANGE', 2)
+    monkeypatch.setattr(script, 'GLPI_CHANGE_OVERLAP', 60)
+    rows = [{'id': i, 'date_mod': d} for i, d in [
+        (5, '2024-05-01 10:00:00'), (3, '2024-05-01 10:00:05'), (4, '2024-05-01 10:00:05'),
+        (6, '2024-05-01 10:00:05'), (1, '2024-05-01 10:00:07')]]
+    calls = []
+
+    async def fake_search(token, since=None, order='ASC', limit=2):
+        calls.append((since, limit))
+        return [row for row in rows if row['date_mod'] > since][:limit]
+
+    monkeypatch.setattr(script, 'search_changed_glpi_tickets', fake_search)
+    tickets = asyncio.run(script.fetch_changed_glpi_tickets('abc', ('2024-05-01 10:00:30', 1)))
+    assert [t['id'] for t in tickets] == [5, 3, 4, 6, 1]
+    assert calls[0] == ('2024-05-01 09:59:30', 2)
+    assert calls[1] == ('2024-05-01 10:00:04', 2)
+
+
+def test_ticket_pipeline_publishes_change_feed(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'UPDATE_MESSAGE', 'Updated:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    monkeypatch.setattr(script, 'TRACK_CHANGES', True)
+    monkeypatch.setattr(script, 'GLPI_CHANGE_OVERLAP', 60)
+
+    async def run():
+        queue = asyncio.Queue()
+        store = script.StateStore(str(tmp_path / 'state.db'))
+        pipeline = script.TicketPipeline(queue, store)
+        pipeline.move_cursor(('2024-05-01 10:00:00', 9))
+        await pipeline.publish_changes([
+            {'id': 4, 'name': 'Old', 'status': 2, 'date_creation': '2024-01-01 08:00:00',
+             'date_mod': '2024-05-01 10:00:10'},
+            {'id': 10, 'name': 'Fresh', 'status': 1, 'date_creation': '2024-05-01 10:00:20',
+             'date_mod': '2024-05-01 10:00:20'},
+        ])
+        await pipeline.publish_changes([
+            {'id': 4, 'name': 'Old', 'status': 5, 'date_creation': '2024-01-01 08:00:00',
+             'date_mod': '2024-05-01 10:01:00'},
+        ])
+        return store.load_cursor(), [queue.get_nowait()[1] for _ in range(queue.qsize())]
+
+    cursor, messages = asyncio.run(run())
+    assert cursor == ('2024-05-01 10:01:00', 4)
+    assert messages == ['New: Fresh (ID: 10)', 'Updated: Old (ID: 4) - status: Solved']
+
+
+def test_fetch_glpi_tickets_by_id_batches_ids(monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_ID_BATCH', 2)
+    queries = []
+
+    async def fake_search(session_token, itemtype, params, fields, description):
+        ids = [int(v) for k, v in params.items() if k.endswith('[value]')]
+        queries.append(params)
+        return [{'id': i, 'name': f'T{i}'} for i in ids]
+
+    monkeypatch.setattr(script, '_search_glpi', fake_search)
+    tickets = asyncio.run(script.fetch_glpi_tickets_by_id('abc', {3, 1, 2}))
+    assert sorted(tickets) == [1, 2, 3]
+    assert len(queries) == 2
+    assert queries[0]['criteria[1][link]'] == 'OR'
+
+
+@patch('script.aiohttp.ClientSession')
+def test_fetch_multiple_glpi_tickets_batches_ids(mock_client_session, monkeypatch):
+    monkeypatch.setattr(script, 'GLPI_API_URL', 'http://glpi')
+    monkeypatch.setattr(script, 'GLPI_APP_TOKEN', 'token')
+    monkeypatch.setattr(script, 'GLPI_ID_BATCH', 2)
+
+    def make_response(params):
+        ids = [v for k, v in params.items() if k.endswith('[items_id]')]
+        response_mock = AsyncMock()
+        response_mock.__aenter__.return_value = response_mock
+        response_mock.__aexit__.return_value = False
+        response_mock.status = 200
+        response_mock.json = AsyncMock(return_value=[{'id': i, 'entities_id': 0} for i in ids])
+        return response_mock
+
+    session_instance = MagicMock(closed=False)
+    session_instance.get = MagicMock(side_effect=lambda url, headers, params: make_response(params))
+    mock_client_session.return_value = session_instance
+
+    tickets = asyncio.run(script.fetch_multiple_glpi_tickets('abc', {3, 1, 2}))
+    assert tickets == {i: {'id': i, 'entities_id': 0} for i in (1, 2, 3)}
+    calls = session_instance.get.call_args_list
+    assert [c.args[0] for c in calls] == ['http://glpi/getMultipleItems'] * 2
+    assert calls[0].kwargs['params']['items[1][itemtype]'] == 'Ticket'
+
+
+def test_poll_glpi_subitems_announces_public_ticket_items(tmp_path, monkeypatch):
+    routes_file = tmp_path / 'routes.json'
+    routes_file.write_text(json.dumps({'routes': [{'room': 'network', 'match': {'category': [7]}}]}))
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    monkeypatch.setattr(script, 'ROUTES_FILE', str(routes_file))
+    monkeypatch.setattr(script, '_routing_tables', {})
+    rows = [{'id': i, 'itemtype': 'Ticket', 'items_id': 1, 'content': 'old'} for i in range(1, 8)]
+    lookups = []
+
+    async def fake_page(session_token, itemtype, limit):
+        return 200, sorted(rows, key=lambda row: -row['id'])[:limit]
+
+    async def fake_by_id(session_token, ticket_ids):
+        lookups.append(ticket_ids)
+        return {1: {'id': 1, 'name': 'VPN', 'itilcategories_id': 7}}
+
+    monkeypatch.setattr(script, '_fetch_newest_glpi_page', fake_page)
+    monkeypatch.setattr(script, 'fetch_multiple_glpi_tickets', fake_by_id)
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 0
+        rows.extend([
+            {'id': 8, 'itemtype': 'Ticket', 'items_id': 1, 'content': '&lt;p&gt;Rebooted &amp;amp; fixed&lt;/p&gt;'},
+            {'id': 9, 'itemtype': 'Ticket', 'items_id': 2, 'content': 'internal', 'is_private': 1},
+            {'id': 10, 'itemtype': 'Change', 'items_id': 3, 'content': 'change'},
+        ])
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 1
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 0
+        return queue.get_nowait()
+
+    notification = asyncio.run(run())
+    assert notification[:2] == ('network', '💬 New follow-up on VPN (ID: 1): Rebooted & fixed')
+    assert lookups == [{1}]
+
+
+def test_poll_glpi_subitems_does_not_seed_from_failed_fetch(monkeypatch):
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    rows = [{'id': i, 'itemtype': 'Ticket', 'items_id': 1, 'content': 'old'} for i in range(1, 4)]
+    statuses = [503, None, 200]
+
+    async def fake_page(session_token, itemtype, limit):
+        status = statuses.pop(0) if statuses else 200
+        return status, sorted(rows, key=lambda row: -row['id'])[:limit] if status == 200 else None
+
+    async def fake_by_id(session_token, ticket_ids):
+        return {1: {'id': 1, 'name': 'VPN'}}
+
+    monkeypatch.setattr(script, '_fetch_newest_glpi_page', fake_page)
+    monkeypatch.setattr(script, 'fetch_multiple_glpi_tickets', fake_by_id)
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        # A server error and a network error leave the itemtype unseeded
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 0
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 0
+        assert pipeline.items_seen('ITILFollowup') is None
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 0
+        rows.append({'id': 4, 'itemtype': 'Ticket', 'items_id': 1, 'content': 'new'})
+        assert await script.poll_glpi_subitems('abc', pipeline, 'ITILFollowup') == 1
+        return [queue.get_nowait()[1] for _ in range(queue.qsize())]
+
+    assert asyncio.run(run()) == ['💬 New follow-up on VPN (ID: 1): new']
+
+
+def test_webhook_requires_valid_signature(monkeypatch):
+    from aiohttp.test_utils import TestClient, TestServer
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        client = TestClient(TestServer(script.make_webhook_app(pipeline, secret='s3cret')))
+        await client.start_server()
+        try:
+            body = b'{"event": "new", "item": {"id": 7, "name": "Printer"}}'
+            timestamp = str(int(script.time.time()))
+            signature = script.hmac.new(b's3cret', body + timestamp.encode(), script.hashlib.sha256).hexdigest()
+            bad = await client.post(script.WEBHOOK_PATH, data=body, headers={
+                'X-GLPI-timestamp': timestamp, 'X-GLPI-signature': 'nope'})
+            good = await client.post(script.WEBHOOK_PATH, data=body, headers={
+                'X-GLPI-timestamp': timestamp, 'X-GLPI-signature': signature})
+            malformed = []
+            for other in (b'[{"id": 8}]', b'{"event": "new", "item": {"id": "abc"}}'):
+                other_signature = script.hmac.new(
+                    b's3cret', other + timestamp.encode(), script.hashlib.sha256).hexdigest()
+                response = await client.post(script.WEBHOOK_PATH, data=other, headers={
+                    'X-GLPI-timestamp': timestamp, 'X-GLPI-signature': other_signature})
+                malformed.append(response.status)
+            return bad.status, good.status, queue.qsize(), malformed
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == (401, 200, 1, [400, 400])
+
+
+def test_webhooks_do_not_move_the_poll_watermark(monkeypatch):
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        pipeline.seed([{'id': 100}])
+        await pipeline.publish([{'id': 105, 'name': 'webhook'}])
+        assert pipeline.poll_watermark == 100
+        # The reconciliation poll searches above 100 and finds the tickets whose webhook was lost
+        polled = [{'id': i, 'name': f'T{i}'} for i in range(101, 106)]
+        assert await pipeline.publish(polled) == 4
+        pipeline.move_poll_watermark(polled)
+        assert pipeline.poll_watermark == 105
+
+    asyncio.run(run())
+
+
+def test_update_webhook_records_older_unseen_ticket_silently(monkeypatch):
+    from aiohttp.test_utils import TestClient, TestServer
+    monkeypatch.setattr(script, 'MESSAGE', 'New:')
+    monkeypatch.setattr(script, 'ROOM_ID', 'room')
+    monkeypatch.setattr(script, 'TRACK_CHANGES', True)
+
+    async def run():
+        queue = asyncio.Queue()
+        pipeline = script.TicketPipeline(queue)
+        pipeline.move_poll_watermark([{'id': 100}])
+        client = TestClient(TestServer(script.make_webhook_app(pipeline, secret='s3cret')))
+        await client.start_server()
+        try:
+            body = b'{"event": "update", "item": {"id": 50, "name": "Old", "status": 2}}'
+            timestamp = str(int(script.time.time()))
+            signature = script.hmac.new(b's3cret', body + timestamp.encode(), script.hashlib.sha256).hexdigest()
+            response = await client.post(script.WEBHOOK_PATH, data=body, headers={
+                'X-GLPI-timestamp': timestamp, 'X-GLPI-signature': signature})
+            return response.status, queue.qsize(), 50 in pipeline.seen
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == (200, 0, True)
+
+
+def test_tenants_override_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(script, 'MATRIX_HOMESERVER', 'http://shared-matrix')
+    monkeypatch.setattr(script, 'ROOM_ID', 'default-room')
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps({'tenants': [
+        {'name': 'acme', 'GLPI_API_URL': 'http://acme/apirest.php', 'ROOM_ID': '!acme'},
+        {'name': 'globex', 'GLPI_API_URL': 'http://globex/apirest.php',
+         'TRACK_CHANGES': 'false', 'WEBHOOK_PORT': '8080'},
+    ]}))
+    acme, globex = script.load_tenants(str(path))
+    assert globex.TRACK_CHANGES is False and globex.WEBHOOK_PORT == 8080
+    assert acme.ROOM_ID == '!acme'
+    assert globex.ROOM_ID == 'default-room'
+    assert acme.MATRIX_HOMESERVER == 'http://shared-matrix'
+    assert acme.state_key == 'tickets:acme'
+
+    async def glpi_url_in(tenant):
+        script._current_tenant.set(tenant)
+        await asyncio.sleep(0)
+        return script.glpi_breaker().name
+
+    async def run():
+        return await asyncio.gather(glpi_url_in(acme), glpi_url_in(globex))
+
+    assert asyncio.run(run()) == ['GLPI http://acme/apirest.php', 'GLPI http://globex/apirest.php']
+    assert script.current_tenant() is script.DEFAULT_TENANT
+
+
+def test_tenants_are_kept_apart(tmp_path, monkeypatch):
+    for var in script.REQUIRED_SETTINGS:
+        monkeypatch.setattr(script, var, 'x')
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps({'tenants': [
+        {'name': 'acme', 'WEBHOOK_PORT': 8080, 'WEBHOOK_SECRET': 's'},
+        {'name': 'globex', 'WEBHOOK_PORT': 8080, 'WEBHOOK_SECRET': 's'},
+    ]}))
+    monkeypatch.setattr(script, 'TENANTS_FILE', str(path))
+    with pytest.raises(SystemExit):
+        script.check_env()
+
+    acme, globex = script.load_tenants(str(path))
+
+    async def txn_id_in(tenant):
+        script._current_tenant.set(tenant)
+        return script.matrix_txn_id(42)
+
+    async def run():
+        return await asyncio.gather(txn_id_in(acme), txn_id_in(globex))
+
+    acme_id, globex_id = asyncio.run(run())
+    assert acme_id != globex_id and '-acme-' in acme_id
+
+
+def test_run_tenant_restarts_failed_monitor(monkeypatch):
+    runs = []
+
+    async def fake_monitor():
+        runs.append(script.current_tenant().name)
+        if len(runs) == 1:
+            raise OSError('address already in use')
+
+    async def fake_sleep(delay):
+        pass
+
+    monkeypatch.setattr(script, '_monitor_glpi_tickets', fake_monitor)
+    monkeypatch.setattr(script.asyncio, 'sleep', fake_sleep)
+    asyncio.run(script.run_tenant(script.Tenant('acme')))
+    assert runs == ['acme', 'acme']
+
+
+def test_shard_tenants_round_robin():
+    tenants = [script.Tenant(f't{i}') for i in range(5)]
+    shards = script.shard_tenants(tenants, 2)
+    assert [[t.name for t in shard] for shard in shards] == [['t0', 't2', 't4'], ['t1', 't3']]
+    assert len(script.shard_tenants(tenants[:1], 4)) == 1
+
+
+def test_worker_reports_stats_over_pipe(monkeypatch):
+    async def fake_monitor(tenants):
+        script.stats['polls'] += 3
+
+    monkeypatch.setattr(script, 'monitor_glpi_tickets', fake_monitor)
+    monkeypatch.setattr(script, 'stats', script.collections.Counter())
+    parent_conn, child_conn = script.multiprocessing.Pipe(duplex=False)
+    asyncio.run(script._run_worker(1, [script.Tenant('acme')], child_conn))
+    report = parent_conn.recv()
+    assert report['worker'] == 1
+    assert report['tenants'] == 1
+    assert report['polls'] == 3
+
+
+def test_supervisor_restarts_dead_worker_and_keeps_totals(monkeypatch, caplog):
+    started = []
+
+    class FakeConn:
+        def __init__(self, reports=()):
+            self.reports = list(reports)
+
+        def poll(self):
+            return bool(self.reports)
+
+        def recv(self):
+            return self.reports.pop(0)
+
+        def close(self):
+            pass
+
+    class FakeProcess:
+        def __init__(self, target, args, name, daemon):
+            self.conn = args[2]
+            self.pid = len(started) + 1
+            self.exitcode = 1
+
+        def start(self):
+            started.append(self)
+            self.conn.reports.append({'worker': 0, 'pid': self.pid, 'tenants': 1, 'polls': 2})
+            # The first worker dies right away, its replacement keeps running
+            self.alive = len(started) > 1
+
+        def is_alive(self):
+            return self.alive
+
+        def terminate(self):
+            self.alive = False
+
+        def join(self, timeout=None):
+            pass
+
+    class FakeContext:
+        Process = FakeProcess
+
+        def Pipe(self, duplex=True):
+            conn = FakeConn()
+            return conn, conn
+
+    async def fake_sleep(delay):
+        if len(started) > 1 and any('polls=4' in r.message for r in caplog.records):
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(script.multiprocessing, 'get_context', lambda method: FakeContext())
+    monkeypatch.setattr(script.asyncio, 'sleep', fake_sleep)
+    monkeypatch.setattr(script, 'STATS_INTERVAL', 0)
+    caplog.set_level('INFO')
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(script.supervise_tenants([script.Tenant('acme')], 1))
+    assert len(started) == 2
+    assert script.worker_restart_delay(1) == 0
+    assert script.worker_restart_delay(3) > 0
+